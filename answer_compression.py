@@ -0,0 +1,69 @@
+import os
+import tempfile
+from math import log2
+import tenseal.sealapi as sealapi
+from parameters import answer_compression, answer_noise_margin
+
+# Serialization and compression of the answers of the server, which are sent as SEAL ciphertexts.
+# An answer ciphertext only has to be decrypted, so with answer_compression the server switches it down the modulus chain of the client context
+# to the smallest coefficient modulus that still leaves answer_noise_margin bits of noise budget.
+# Modulus switching scales the noise of the ciphertext down with the modulus and adds a rounding noise of about
+# plain_modulus * sqrt(poly_modulus_degree), so the noise budget after switching to a modulus q is about
+# min(budget before switching, log2(q) - log2(plain_modulus) - rounding_noise_bits).
+# SEAL only saves and loads ciphertexts through files, hence the temporary files.
+
+def rounding_noise_bits(poly_modulus_degree):
+    return log2(poly_modulus_degree) / 2 + 2
+
+def answer_parms_id(seal_context):
+    '''
+    :param seal_context: the SEAL context of the client
+    :return: the parms_id of the last level of the modulus chain whose coefficient modulus keeps answer_noise_margin bits of noise budget after modulus switching
+    '''
+    context_data = seal_context.first_context_data()
+    parms = context_data.parms()
+    needed_bits = log2(parms.plain_modulus().value()) + rounding_noise_bits(parms.poly_modulus_degree()) + answer_noise_margin
+    while context_data.next_context_data() is not None and context_data.next_context_data().total_coeff_modulus_bit_count() >= needed_bits:
+        context_data = context_data.next_context_data()
+    return context_data.parms_id()
+
+def save_ciphertext(ciphertext, directory):
+    filename = os.path.join(directory, 'ciphertext')
+    ciphertext.save(filename)
+    with open(filename, 'rb') as f:
+        return f.read()
+
+def serialize_answer(answer, seal_context):
+    '''
+    :param answer: an encrypted answer, as a SEAL ciphertext of the context of the client (switched in place if answer_compression)
+    :param seal_context: the SEAL context of the client
+    :return: (the answer saved as a SEAL ciphertext, switched to answer_parms_id if answer_compression, the number of bytes saved by the switch)
+    '''
+    with tempfile.TemporaryDirectory() as directory:
+        if not answer_compression:
+            return save_ciphertext(answer, directory), 0
+        full_size = len(save_ciphertext(answer, directory))
+        sealapi.Evaluator(seal_context).mod_switch_to_inplace(answer, answer_parms_id(seal_context))
+        compressed = save_ciphertext(answer, directory)
+    return compressed, full_size - len(compressed)
+
+def decrypt_answer(private_context, compressed):
+    '''
+    :param private_context: the private TenSEAL context of the client
+    :param compressed: an answer written by serialize_answer
+    :return: (the decryption of the answer, as a list of poly_modulus_degree integers, the estimated number of bytes saved by the compression)
+    '''
+    seal_context = private_context.seal_context().data
+    ciphertext = sealapi.Ciphertext()
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, 'ciphertext')
+        with open(filename, 'wb') as f:
+            f.write(compressed)
+        ciphertext.load(seal_context, filename)
+    plaintext = sealapi.Plaintext()
+    sealapi.Decryptor(seal_context, private_context.secret_key().data).decrypt(ciphertext, plaintext)
+    decryption = sealapi.BatchEncoder(seal_context).decode_uint64(plaintext)
+    # the size of a ciphertext grows linearly with the number of primes of its coefficient modulus
+    full_primes = len(seal_context.first_context_data().parms().coeff_modulus())
+    saved = len(compressed) * (full_primes - ciphertext.coeff_modulus_size()) // ciphertext.coeff_modulus_size()
+    return decryption, saved
@@ -1,4 +1,5 @@
-from math import log2
+from math import log2, ceil
+from functools import lru_cache
 import numpy as np
 from parameters import ell, plain_modulus, bin_capacity, alpha
 
@@ -58,19 +59,30 @@ def power_reconstruct(window, exponent):
     return low_depth_multiplication(necessary_powers)
 
 
-def windowing(y, bound, modulus):
+def batched_windowing(items, bound, modulus):
     '''
-    :param: y: an integer
+    :param items: a NumPy array of nonnegative integers (in the protocol, the whole Cuckoo table)
     :param bound: an integer
-    :param modulus: a modulus integer
-    :return: a matrix associated to y, where we put y ** (i+1)*base ** j mod modulus in the (i,j) entry, as long as the exponent of y is smaller than some bound
+    :param modulus: a modulus integer, smaller than 2 ** 32
+    :return: an array with a row for every exponent (i+1) * base ** j of window_exponents(ell, bound), holding items ** exponent mod modulus;
+    each row is the plaintext vector of one ciphertext of the windowed query
     '''
-    windowed_y = [[None for j in range(logB_ell)] for i in range(base-1)]
-    for j in range(logB_ell):
-        for i in range(base-1):
-            if ((i+1) * base ** j - 1 < bound):
-                windowed_y[i][j] = pow(y, (i+1) * base ** j, modulus)
-    return windowed_y
+    if modulus >= 2 ** 32:
+        raise ValueError('the products modulo {} do not fit in 64 bits'.format(modulus))
+    modulus = np.uint64(modulus)
+    # items ** (base ** j), for the current j
+    power = np.asarray(items).astype(np.uint64) % modulus
+    rows = []
+    for j in range(int(log2(bound) / ell) + 1):
+        product = power
+        for i in range(base - 1):
+            if (i + 1) * base ** j > bound:
+                break
+            rows.append(product)
+            product = product * power % modulus
+        for k in range(ell):
+            power = power * power % modulus
+    return np.array(rows, dtype=np.int64)
 
 
 def coeffs_from_roots(roots, modulus):
@@ -82,4 +94,152 @@ def coeffs_from_roots(roots, modulus):
     coefficients = np.array(1, dtype=np.int64)
     for r in roots:
         coefficients = np.convolve(coefficients, [1, -r]) % modulus
-    return coefficients
\ No newline at end of file
+    return coefficients
+
+def coeffs_from_minibins(minibins, modulus, chunk_size=2 ** 16):
+    '''
+    :param minibins: an array of integers of shape (number_of_bins, alpha, minibin_capacity), where minibins[i][j] holds the roots of the j-th minibin of bin i
+    :param modulus: an integer smaller than 2 ** 31
+    :param chunk_size: the number of minibins processed together (it bounds the memory used for intermediate results)
+    :return: an array of shape (number_of_bins, alpha * (minibin_capacity + 1)), whose i-th row concatenates coeffs_from_roots(minibins[i][j], modulus) for j = 0, ..., alpha - 1
+    '''
+    number_of_bins, number_of_minibins, degree = minibins.shape
+    roots = minibins.reshape(-1, degree)
+    coefficients = np.empty((len(roots), degree + 1), dtype=np.int64)
+    for start in range(0, len(roots), chunk_size):
+        # the polynomials of the chunk are stored column by column, so that each coefficient is a contiguous row
+        chunk_roots = np.ascontiguousarray(roots[start: start + chunk_size].T).astype(np.int64) % modulus
+        chunk_coefficients = np.zeros((degree + 1, chunk_roots.shape[1]), dtype=np.int64)
+        chunk_coefficients[0] = 1
+        for k in range(degree):
+            # all the polynomials are multiplied by (X - root): coefficient i becomes coefficient i - root * coefficient i-1
+            chunk_coefficients[1: k + 2] = (chunk_coefficients[1: k + 2] - chunk_roots[k] * chunk_coefficients[: k + 1]) % modulus
+        coefficients[start: start + chunk_size] = chunk_coefficients.T
+    return coefficients.reshape(number_of_bins, number_of_minibins * (degree + 1))
+
+
+def window_exponents(ell, minibin_capacity):
+    '''
+    :param ell: the windowing parameter
+    :param minibin_capacity: an integer
+    :return: the exponents (i + 1) * base ** j, at most minibin_capacity, of the powers Enc(y ** exponent) in the windowed query
+    '''
+    base = 2 ** ell
+    logB_ell = int(log2(minibin_capacity) / ell) + 1
+    return [(i + 1) * base ** j for j in range(logB_ell) for i in range(base - 1) if (i + 1) * base ** j <= minibin_capacity]
+
+@lru_cache(maxsize=None)
+def power_depths(ell, minibin_capacity):
+    '''
+    :return: an array whose entry k is the smallest multiplicative depth of Enc(y ** k), computed from the windowed query, for k from 1 to minibin_capacity (entry 0 is unused)
+    The powers of depth at most d + 1 are the sums of two powers of depth at most d, so every level is found with one convolution.
+    '''
+    depth = np.full(minibin_capacity + 1, -1, dtype=np.int64)
+    depth[window_exponents(ell, minibin_capacity)] = 0
+    d = 0
+    while (depth[1:] < 0).any():
+        reached = (depth >= 0).astype(np.int64)
+        d += 1
+        depth[(np.convolve(reached, reached)[: minibin_capacity + 1] > 0) & (depth < 0)] = d
+    return depth
+
+@lru_cache(maxsize=None)
+def power_plan(ell, minibin_capacity, targets=None, max_depth=None):
+    '''
+    :param ell: the windowing parameter
+    :param minibin_capacity: an integer
+    :param targets: a tuple with the exponents k for which Enc(y ** k) is needed (by default, all the exponents from 1 to minibin_capacity)
+    :param max_depth: a bound on the multiplicative depth of the computed powers
+    :return: (levels, multiplications, depth), where levels[d] is a list of steps (k, a, b), meaning Enc(y ** k) = Enc(y ** a) * Enc(y ** b), which only use the window and the previous levels
+    Every power gets the smallest possible depth (see power_depths); among the products giving this depth, we take the first one that needs fewest powers besides the window and the targets.
+    A power is computed once and shared by all the steps using it, so the plan needs one multiplication per power which is not in the window.
+    '''
+    depth = power_depths(ell, minibin_capacity)
+    window = set(window_exponents(ell, minibin_capacity))
+    targets = range(1, minibin_capacity + 1) if targets is None else targets
+    wanted = window | set(targets)
+    # the parts of a product have smaller depths, so the depth of the plan is the one of its deepest target
+    plan_depth = max(int(depth[k]) for k in targets)
+    if max_depth is not None and plan_depth > max_depth:
+        raise ValueError('the powers need multiplicative depth {}, more than {}'.format(plan_depth, max_depth))
+
+    # only the powers needed for the targets are decomposed
+    decomposition = {}
+    stack = [k for k in targets if k not in window]
+    while stack:
+        k = stack.pop()
+        if k in decomposition:
+            continue
+        # the products Enc(y ** a) * Enc(y ** (k - a)), for a <= k / 2, which give the smallest depth
+        candidates = np.flatnonzero(np.maximum(depth[1: k // 2 + 1], depth[k - 1: k - k // 2 - 1: -1]) == depth[k] - 1) + 1
+        best = None
+        for a in candidates.tolist():
+            extra = (a not in wanted) + (k - a not in wanted)
+            if best is None or extra < best[0]:
+                best = (extra, a)
+                if extra == 0:
+                    break
+        a = best[1]
+        decomposition[k] = (a, k - a)
+        stack = stack + [part for part in decomposition[k] if part not in window]
+    levels = [[(k,) + decomposition[k] for k in sorted(decomposition) if depth[k] == d] for d in range(1, plan_depth + 1)]
+    return levels, len(decomposition), plan_depth
+
+def flat_plan(ell, minibin_capacity, max_depth=None):
+    '''
+    :param max_depth: a bound on the multiplicative depth of the evaluation, where a multiplication by a plaintext counts as one level
+    :return: (levels, multiplications, depth) for the evaluation of the minibin polynomials on all the powers, computed following levels;
+    the multiplications of the powers by the coefficients take the last level of depth
+    '''
+    levels, multiplications, depth = power_plan(ell, minibin_capacity, max_depth=None if max_depth is None else max_depth - 1)
+    return levels, multiplications, depth + 1
+
+def power_reconstruct_cost(ell, minibin_capacity):
+    '''
+    :return: the number of ciphertext-ciphertext multiplications and the multiplicative depth of computing all the powers up to minibin_capacity with power_reconstruct
+    '''
+    base = 2 ** ell
+    window = window_exponents(ell, minibin_capacity)
+    multiplications = 0
+    depth = 0
+    for k in range(1, minibin_capacity + 1):
+        if k not in window:
+            factors = len([x for x in int2base(k, base) if x >= 1])
+            multiplications = multiplications + factors - 1
+            depth = max(depth, int(ceil(log2(factors))))
+    return multiplications, depth
+
+@lru_cache(maxsize=None)
+def paterson_stockmeyer_plan(ell, minibin_capacity, alpha, max_depth=None):
+    '''
+    :param ell: the windowing parameter
+    :param minibin_capacity: the degree of the minibin polynomials
+    :param alpha: the number of minibin polynomials evaluated on the same powers
+    :param max_depth: a bound on the multiplicative depth of the evaluation, where a multiplication by a plaintext counts as one level
+    :return: (baby_steps, levels, multiplications, depth) for the Paterson-Stockmeyer evaluation of the alpha polynomials:
+    P(y) = sum over g of y ** (g * baby_steps) * (sum over b < baby_steps of the coefficient of y ** (g * baby_steps + b) times y ** b),
+    where the baby steps y, ..., y ** (baby_steps - 1) and the giant steps y ** baby_steps, y ** (2 * baby_steps), ... are computed once (following levels) for all the polynomials.
+    The number of baby steps is chosen to minimize the ciphertext-ciphertext multiplications, both for the powers and for the giant steps of the alpha polynomials.
+    For each number of giant steps, only the smallest number of baby steps is tried.
+    '''
+    # every power of the plans gets its smallest depth, so the depth of the evaluation is known before its plan is built
+    depths = power_depths(ell, minibin_capacity)
+    best = None
+    for baby_steps in range(2, minibin_capacity + 2):
+        giant_steps = -(-(minibin_capacity + 1) // baby_steps)
+        if baby_steps > 2 and giant_steps == -(-(minibin_capacity + 1) // (baby_steps - 1)):
+            continue
+        # the baby steps are multiplied by plaintexts, and then by the giant steps
+        depth = int(depths[1: baby_steps].max()) + 1
+        if giant_steps > 1:
+            depth = max(depth, int(depths[baby_steps: (giant_steps - 1) * baby_steps + 1: baby_steps].max())) + 1
+        if max_depth is not None and depth > max_depth:
+            continue
+        targets = tuple(range(1, baby_steps)) + tuple(g * baby_steps for g in range(1, giant_steps))
+        levels, power_multiplications, power_depth = power_plan(ell, minibin_capacity, targets)
+        multiplications = power_multiplications + alpha * (giant_steps - 1)
+        if best is None or (multiplications, depth) < (best[2], best[3]):
+            best = (baby_steps, levels, multiplications, depth)
+    if best is None:
+        raise ValueError('the Paterson-Stockmeyer evaluation needs multiplicative depth more than {}'.format(max_depth))
+    return best
@@ -0,0 +1,224 @@
+import argparse
+import asyncio
+import contextlib
+import json
+import multiprocessing
+import os
+import platform
+import queue
+import resource
+import runpy
+from time import time, strftime
+
+import parameters
+from parameter_tuner import calibrate, tune, validate
+from set_files import read_items
+
+# Runs the whole protocol (set_gen.py, server_offline.py, client_offline.py, server_online.py and client_online.py) for several sizes of the sets,
+# and records for every phase the wall time, the CPU time and the peak RSS, and the bytes sent between the client and the server.
+# Every configuration runs in a fresh process, with the parameter set chosen by parameter_tuner.py;
+# inside it, every phase runs in a process of its own, so that its peak RSS is its own, and the client talks to the server over loopback.
+
+repository = os.path.dirname(os.path.abspath(__file__))
+# a phase slower than its baseline by more than this fraction (and by more than noise_seconds) is reported as a regression
+default_tolerance = 0.2
+noise_seconds = 0.05
+# the serialized ciphertexts are compressed, so their sizes vary a little from run to run
+bytes_tolerance = 0.01
+# the variables of client_online.py kept for the results
+client_variables = ['client_intersection', 'client_to_server_communiation_oprf', 'client_to_server_communiation_query',
+                    'server_to_client_communication_oprf', 'server_to_client_query_response']
+
+
+def resources():
+    '''
+    :return: the CPU time of this process and of its finished children, and the peak RSS (in MB) of this process and of its largest finished child
+    The worker processes are counted once they are joined, so every phase stops the ones it started.
+    '''
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime, max(own.ru_maxrss, children.ru_maxrss) / 1024
+
+def run_script(name):
+    '''
+    Runs the script name as __main__, then stops the pool of OPRF worker processes it may have started.
+    :return: the global variables of the script
+    '''
+    script_globals = runpy.run_path(os.path.join(repository, name), run_name='__main__')
+    import oprf
+    if oprf.pool is not None:
+        oprf.pool.close()
+        oprf.pool.join()
+        oprf.pool = None
+    return script_globals
+
+def run_phase(name, variables, results):
+    '''
+    Runs the script name in this process (forked for the phase), and puts in results its CPU time, its peak RSS and the values of the given variables of the script.
+    '''
+    with open('benchmark.log', 'a') as log, contextlib.redirect_stdout(log):
+        script_globals = run_script(name)
+    results.put(resources() + ({variable: script_globals[variable] for variable in variables},))
+
+def serve(ready, stop, results):
+    '''
+    Runs server_online.py in this process (forked for the phase) until stop is set, then puts in results its CPU time and its peak RSS.
+    '''
+    import server_online
+
+    async def serve_until_stopped():
+        serving = asyncio.ensure_future(server_online.main(ready))
+        await asyncio.get_running_loop().run_in_executor(None, stop.wait)
+        # stopping the server joins its worker processes
+        serving.cancel()
+        await asyncio.gather(serving, return_exceptions=True)
+
+    with open('benchmark.log', 'a') as log, contextlib.redirect_stdout(log):
+        asyncio.run(serve_until_stopped())
+    results.put(resources() + ({},))
+
+def result_of(process, results, description):
+    '''
+    :return: the item put in the queue results by process, which is then joined; a RuntimeError is raised if the process ends without putting it
+    '''
+    while True:
+        try:
+            result = results.get(timeout=1)
+            break
+        except queue.Empty:
+            if not process.is_alive():
+                raise RuntimeError('{} failed, see its benchmark.log'.format(description))
+    process.join()
+    return result
+
+def measure(phases, name, target, args, description):
+    '''
+    Runs target(*args, results) in a forked process, and records its wall time, CPU time and peak RSS (with the ones of its worker processes) as phases[name].
+    :return: the values of the variables returned by target
+    '''
+    context = multiprocessing.get_context('fork')
+    results = context.Queue()
+    t0 = time()
+    process = context.Process(target=target, args=args + (results,))
+    process.start()
+    cpu_time, peak_rss, values = result_of(process, results, description)
+    phases[name] = {'wall_time': time() - t0, 'cpu_time': cpu_time, 'peak_rss_mb': peak_rss}
+    return values
+
+def run_configuration(directory, results):
+    '''
+    Runs all the phases of the protocol in directory (with the parameters of the file PSI_PARAMETERS) and puts the measurements in the queue results.
+    '''
+    os.chdir(directory)
+    # the scripts run as __main__ without a guard for their top-level code, so their worker processes must be forked, not spawned
+    multiprocessing.set_start_method('fork', force=True)
+    open('benchmark.log', 'w').close()
+    phases = {}
+    for name in ['set_gen', 'server_offline', 'client_offline']:
+        measure(phases, name, run_phase, (name + '.py', []), '{}.py in {}'.format(name, directory))
+
+    # The server runs in a process of its own until the client is done; its phase covers its start and the whole online phase
+    context = multiprocessing.get_context('fork')
+    ready, stop, server_results = context.Event(), context.Event(), context.Queue()
+    t0 = time()
+    server = context.Process(target=serve, args=(ready, stop, server_results))
+    server.start()
+    while not ready.wait(1):
+        if not server.is_alive():
+            raise RuntimeError('server_online.py in {} failed, see its benchmark.log'.format(directory))
+    server_start = time() - t0
+    try:
+        client = measure(phases, 'online', run_phase, ('client_online.py', client_variables), 'client_online.py in {}'.format(directory))
+    finally:
+        stop.set()
+    cpu_time, peak_rss, values = result_of(server, server_results, 'server_online.py in {}'.format(directory))
+    phases['server_online'] = {'wall_time': time() - t0, 'cpu_time': cpu_time, 'peak_rss_mb': peak_rss, 'start_time': server_start}
+
+    real_intersection = set(read_items('intersection'))
+    results.put({'phases': phases,
+                 'bytes': {'client_to_server': client['client_to_server_communiation_oprf'] + client['client_to_server_communiation_query'],
+                           'server_to_client': client['server_to_client_communication_oprf'] + client['server_to_client_query_response']},
+                 'correct': set(client['client_intersection']) == real_intersection})
+
+def benchmark(server_size, client_size, cost_model, bandwidth, directory):
+    '''
+    :return: the measurements of one configuration
+    '''
+    latency, parameter_set, seconds, communication, plan = tune(server_size, client_size, bandwidth, cost_model)
+    parameter_set['intersection_size'] = min(parameters.intersection_size, client_size)
+    validate(parameter_set)
+    os.makedirs(directory, exist_ok=True)
+    parameters_file = os.path.join(directory, 'psi_parameters.json')
+    with open(parameters_file, 'w') as f:
+        json.dump(parameter_set, f, indent=4)
+
+    # a fresh process, which reads the parameters when it imports parameters.py
+    os.environ['PSI_PARAMETERS'] = parameters_file
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    process = context.Process(target=run_configuration, args=(directory, results))
+    process.start()
+    measurements = result_of(process, results, 'the configuration in {}'.format(directory))
+    del os.environ['PSI_PARAMETERS']
+
+    measurements.update({'server_size': server_size, 'client_size': client_size, 'parameters': parameter_set,
+                         'predicted': {'server_time': seconds, 'communication': communication}})
+    return measurements
+
+def compare(results, baseline, tolerance):
+    '''
+    :return: the regressions of results with respect to baseline: the phases slower by more than tolerance, and the larger communication
+    '''
+    regressions = []
+    baseline_configurations = {(c['server_size'], c['client_size']): c for c in baseline['configurations']}
+    for configuration in results['configurations']:
+        old = baseline_configurations.get((configuration['server_size'], configuration['client_size']))
+        if old is None:
+            continue
+        name = 'server 2^{:g}, client {}'.format(configuration['server_size'].bit_length() - 1, configuration['client_size'])
+        for phase_name, measurements in configuration['phases'].items():
+            if phase_name in old['phases'] and measurements['wall_time'] > max((1 + tolerance) * old['phases'][phase_name]['wall_time'], old['phases'][phase_name]['wall_time'] + noise_seconds):
+                regressions.append('{}, {}: {:.2f}s -> {:.2f}s'.format(name, phase_name, old['phases'][phase_name]['wall_time'], measurements['wall_time']))
+        for direction, size in configuration['bytes'].items():
+            if size > (1 + bytes_tolerance) * old['bytes'][direction]:
+                regressions.append('{}, {} bytes: {} -> {}'.format(name, direction, old['bytes'][direction], size))
+        if old['correct'] and not configuration['correct']:
+            regressions.append('{}: the intersection is no longer correct'.format(name))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks the whole PSI protocol for several sizes of the sets.')
+    parser.add_argument('--server-sizes', type=int, nargs='+', default=[16, 18, 20, 22, 24], help='log2 of the server sizes')
+    parser.add_argument('--client-sizes', type=int, nargs='+', default=[parameters.client_size])
+    parser.add_argument('--bandwidth', type=float, default=10 ** 8, help='bits per second, used by the parameter tuner')
+    parser.add_argument('--directory', default='benchmark', help='where the sets and databases of each configuration are written')
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--baseline', help='a previous output to compare with')
+    parser.add_argument('--tolerance', type=float, default=default_tolerance)
+    arguments = parser.parse_args()
+
+    cost_model = calibrate(parameters.poly_modulus_degree, parameters.plain_modulus)
+    results = {'date': strftime('%Y-%m-%d %H:%M:%S'), 'machine': {'platform': platform.platform(), 'processor': platform.processor(), 'cpus': os.cpu_count()},
+               'cost_model': cost_model, 'configurations': []}
+    for exponent in arguments.server_sizes:
+        for client_size in arguments.client_sizes:
+            directory = os.path.abspath(os.path.join(arguments.directory, 'server_{}_client_{}'.format(exponent, client_size)))
+            configuration = benchmark(2 ** exponent, client_size, cost_model, arguments.bandwidth, directory)
+            results['configurations'].append(configuration)
+            print('server 2^{}, client {}: {}, {:.2f} MB sent, {:.2f} MB received by the client, intersection {}'.format(
+                exponent, client_size, ', '.join('{} {:.2f}s'.format(name, p['wall_time']) for name, p in configuration['phases'].items()),
+                configuration['bytes']['client_to_server'] / 2 ** 20, configuration['bytes']['server_to_client'] / 2 ** 20,
+                'correct' if configuration['correct'] else 'WRONG'))
+            # the results are written after every configuration, so that a long sweep can be interrupted
+            with open(arguments.output, 'w') as f:
+                json.dump(results, f, indent=4)
+
+    if arguments.baseline:
+        with open(arguments.baseline) as f:
+            regressions = compare(results, json.load(f), arguments.tolerance)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        if regressions:
+            raise SystemExit(1)
+        print('No regression with respect to {}'.format(arguments.baseline))
@@ -1,29 +1,60 @@
-from math import log2
-from math import comb
+from math import log, log1p, lgamma
 
-no_of_hashes = 3 
-m = 2 ** 13 #no of bins
-server_size = 2 ** 20 
-d = no_of_hashes * server_size
-security_bits = 30 #lambda
+# The bin capacity B is the smallest integer such that, when the d = number_of_hashes * server_size entries are thrown at random into m bins,
+# the probability that a bin gets more than B entries is at most 2 ** (-security_bits) / m,
+# i.e. P(X > B) <= 2 ** (-security_bits) / m, for X ~ Binomial(d, 1 / m).
+# The probabilities are computed in log space, so the estimate takes milliseconds for any server size.
 
-md_1 = m ** (d-1)
+def log_binomial_probability(d, i, p):
+	'''
+	:return: the natural logarithm of P(X = i), for X ~ Binomial(d, p)
+	'''
+	return lgamma(d + 1) - lgamma(i + 1) - lgamma(d - i + 1) + i * log(p) + (d - i) * log1p(-p)
 
-s = 0
-S = m ** d
-i = 0
-power_of_m_1 = (m-1) ** d
-TV = True
+def log2_tail(d, B, p):
+	'''
+	:return: log2 of P(X > B), for X ~ Binomial(d, p)
+	'''
+	i = B + 1
+	if i > d:
+		return float('-inf')
+	if i <= d * p:
+		# below the mean, the tail is larger than 1 / 2
+		return 0.0
+	# after the mode, the ratio between consecutive probabilities is (d - i) / (i + 1) * p / (1 - p) < 1, so we sum until the terms are negligible
+	term = 1.0
+	tail = 1.0
+	while term > 2 ** -60 * tail and i < d:
+		term = term * (d - i) / (i + 1) * p / (1 - p)
+		tail = tail + term
+		i = i + 1
+	return (log_binomial_probability(d, B + 1, p) + log(tail)) / log(2)
 
-while TV == True:
-	print(i)
-	current_term = comb(d,i) * power_of_m_1
-	s = s + current_term	
-	S = S - current_term
-	if int(log2(md_1) - log2(S)) >= security_bits:
-		TV = False 
-	i = i + 1
-	power_of_m_1 = power_of_m_1 // (m-1)
+def bin_capacity(server_size, output_bits, number_of_hashes, security_bits=30):
+	'''
+	:param server_size: the number of items of the server
+	:param output_bits: the number of bins is 2 ** output_bits
+	:param number_of_hashes: every item is hashed to number_of_hashes bins
+	:param security_bits: the probability that some bin overflows is at most 2 ** (-security_bits)
+	:return: the bin capacity
+	'''
+	d = number_of_hashes * server_size
+	p = 2.0 ** -output_bits
+	# binary search for the smallest B with log2(m) + log2(P(X > B)) <= -security_bits
+	low, high = 0, d
+	while low < high:
+		B = (low + high) // 2
+		if output_bits + log2_tail(d, B, p) <= -security_bits:
+			high = B
+		else:
+			low = B + 1
+	return low
 
-print('--------------------')
-print('bin_capacity = {}'.format(i-1))
+
+if __name__ == '__main__':
+	no_of_hashes = 3
+	output_bits = 13 #no of bins = 2 ** output_bits
+	server_size = 2 ** 20
+	security_bits = 30 #lambda
+
+	print('bin_capacity = {}'.format(bin_capacity(server_size, output_bits, no_of_hashes, security_bits)))
@@ -1,26 +1,21 @@
-import pickle
-from oprf import client_prf_offline, order_of_generator, G
-from time import time
+from psi import PSIClient
+from set_files import read_items
+from instrumentation import metrics, metrics_summary, export_metrics
 
 # client's PRF secret key (a value from  range(order_of_generator))
 oprf_client_key = 12345678910111213141516171819222222222222
-t0 = time()
+# the scripts may run one after the other in the same process (as in benchmark.py), so the Metrics start empty
+metrics.reset()
 
-# key * generator of elliptic curve
-client_point_precomputed = (oprf_client_key % order_of_generator) * G
+client_set = read_items('client_set')
 
-client_set = []
-f = open('client_set', 'r')
-lines = f.readlines()
-for item in lines:
-	client_set.append(int(item[:-1]))
-f.close()
-
-# OPRF layer: encode the client's set as elliptic curve points.
-encoded_client_set = [client_prf_offline(item, client_point_precomputed) for item in client_set]
+# OPRF layer: encode the client's set as elliptic curve points, stored compressed, as they are sent to the server
+encoded_client_set = PSIClient(oprf_client_key).offline(client_set)
 
 g = open('client_preprocessed', 'wb')
-pickle.dump(encoded_client_set, g)	 
+g.write(encoded_client_set)	 
 g.close()   
-t1 = time()
-print('Client OFFLINE time: {:.2f}s'.format(t1-t0))
+print('Client OFFLINE time: {:.2f}s'.format(metrics.computation_time(['oprf'])))
+snapshot = metrics.snapshot()
+print(metrics_summary(snapshot))
+export_metrics('client_offline', snapshot)
@@ -0,0 +1,103 @@
+import struct
+import tenseal.sealapi as sealapi
+from parameters import poly_modulus_degree, output_bits, stash_size
+from oprf import coordinate_bytes
+
+# Every message is sent as a frame: a header with the type of the frame (1 byte) and the length of its payload (8 bytes), followed by the payload
+frame_header = struct.Struct('<BQ')
+
+# the types of the frames
+oprf_query_frame = 1 # the encoded client set, as compressed points on the elliptic curve
+oprf_answer_frame = 2 # the compressed points multiplied by the key of the server
+context_frame = 3 # the serialized public HE context of the client
+query_frame = 4 # one serialized ciphertext of the windowed query
+answer_frame = 5 # one serialized ciphertext of the answer of the server
+shard_batch_frame = 6 # the index of the batch of bins of the next query, sent by the sharded server to the shard owning the batch (see batch_index)
+stash_batches_frame = 7 # the indices of the batches of bins of the extra queries for the Cuckoo stash of the client, one batch_index each (possibly none)
+
+frame_names = {oprf_query_frame: 'OPRF query', oprf_answer_frame: 'OPRF answer', context_frame: 'context', query_frame: 'query ciphertext', answer_frame: 'answer ciphertext', shard_batch_frame: 'shard batch', stash_batches_frame: 'stash batches'}
+
+# the payload of a shard_batch_frame, and the entries of a stash_batches_frame
+batch_index = struct.Struct('<Q')
+
+# the largest payload expected in a frame of each type; frames announcing a longer payload are rejected before anything is allocated for them.
+# A ciphertext takes 8 bytes per coefficient for each prime of the (default) coefficient modulus of the context and each of its (at most 3) polynomials,
+# and the public context is mostly made of the relinearization keys, one ciphertext per prime; serialization_slack covers the headers of the formats.
+# The OPRF frames hold at most one point per bin of the Cuckoo table, and the client makes at most one extra query per item of its stash.
+coeff_primes = len(sealapi.CoeffModulus.BFVDefault(poly_modulus_degree, sealapi.SEC_LEVEL_TYPE.TC128))
+serialization_slack = 2 ** 16
+max_ciphertext_length = 3 * poly_modulus_degree * coeff_primes * 8 + serialization_slack
+max_points_length = 2 ** output_bits * coordinate_bytes + 2 ** output_bits // 8
+max_payload_lengths = {oprf_query_frame: max_points_length, oprf_answer_frame: max_points_length, context_frame: coeff_primes * max_ciphertext_length,
+                       query_frame: max_ciphertext_length, answer_frame: max_ciphertext_length, shard_batch_frame: batch_index.size,
+                       stash_batches_frame: stash_size * batch_index.size}
+
+def check_header(header, expected_type):
+    '''
+    :return: the length of the payload of a frame with the given header, after checking its type and length
+    '''
+    frame_type, length = frame_header.unpack(header)
+    if frame_type != expected_type:
+        raise ValueError('expected a {} frame, received a {} frame'.format(frame_names[expected_type], frame_names.get(frame_type, 'unknown')))
+    if length > max_payload_lengths[expected_type]:
+        raise ValueError('the {} frame is too long: {} bytes'.format(frame_names[expected_type], length))
+    return length
+
+def receive_exactly(sock, view):
+    '''
+    Fills the memoryview view with bytes received from the (blocking) socket sock.
+    '''
+    received = 0
+    while received < len(view):
+        size = sock.recv_into(view[received:])
+        if size == 0:
+            raise ConnectionError('connection closed by the peer')
+        received += size
+
+class Frame_receiver:
+    '''
+    Receives frames from a blocking socket, with their payloads received directly into a buffer which is reused from one frame to the next.
+    '''
+    def __init__(self, sock):
+        self.sock = sock
+        self.header = bytearray(frame_header.size)
+        self.buffer = bytearray()
+
+    def receive(self, expected_type):
+        '''
+        :param expected_type: the type of the frame that should come next
+        :return: a memoryview of the payload, valid until the next frame is received
+        '''
+        receive_exactly(self.sock, memoryview(self.header))
+        length = check_header(self.header, expected_type)
+        if len(self.buffer) < length:
+            # a new buffer, since the previous one may still be viewed
+            self.buffer = bytearray(length)
+        view = memoryview(self.buffer)[:length]
+        receive_exactly(self.sock, view)
+        return view
+
+def send_frame(sock, frame_type, payload):
+    '''
+    Sends the payload in a frame of the given type, on the blocking socket sock.
+    :return: the number of bytes sent
+    '''
+    sock.sendall(frame_header.pack(frame_type, len(payload)))
+    sock.sendall(payload)
+    return frame_header.size + len(payload)
+
+async def read_frame(reader, expected_type):
+    '''
+    :param reader: an asyncio StreamReader
+    :param expected_type: the type of the frame that should come next
+    :return: the payload of the frame
+    '''
+    length = check_header(await reader.readexactly(frame_header.size), expected_type)
+    return await reader.readexactly(length)
+
+def write_frame(writer, frame_type, payload):
+    '''
+    Writes the payload in a frame of the given type, on the asyncio StreamWriter writer (which should be drained afterwards).
+    '''
+    writer.write(frame_header.pack(frame_type, len(payload)))
+    writer.write(payload)
@@ -1,12 +1,16 @@
-from random import randint 
 import math
 import mmh3
+import numpy as np
+from simple_hash import location_array
 
 #parameters
-from parameters import output_bits, number_of_hashes
+from parameters import output_bits, number_of_hashes, sigma_max, stash_size, poly_modulus_degree
 mask_of_power_of_2 = 2 ** output_bits - 1
 log_no_hashes = int(math.log(number_of_hashes) / math.log(2)) + 1
 
+# the empty places of the Cuckoo table hold dummy_msg_client, which is larger than any item_left || index
+dummy_msg_client = 2 ** (sigma_max - output_bits + log_no_hashes)
+
 
 #The hash family used for Cuckoo hashing relies on the Murmur hash family (mmh3)
 
@@ -21,70 +25,124 @@ def location(seed, item):
 	hash_item_left = mmh3.hash(str(item_left), seed, signed=False) >> (32 - output_bits)
 	return hash_item_left ^ item_right
 
-def left_and_index(item, index): 
-	'''
-	:param item: an integer
-	:param index: a log_no_hashes bits integer
-	:return: an integer represented as item_left || index 
-	'''
-	return ((item >> (output_bits)) << (log_no_hashes)) + index 	
-
-def extract_index(item_left_and_index): 
-	'''
-	:param item_left_and_index: an integer represented as item_left || index
-	:return: index extracted
-	'''
-	return item_left_and_index & (2 ** log_no_hashes - 1) 
-
-def reconstruct_item(item_left_and_index, current_location, seed):
-	'''
-	:param item_left_and_index: an integer represented as item_left || index
-	:param current_location: the corresponding location, i.e. Murmur_hash(item_left) xor item_right
-	:param seed: the seed of the Murmur hash function
-	:return: the integer item
-	'''
-	item_left = item_left_and_index >> log_no_hashes
-	hashed_item_left = mmh3.hash(str(item_left), seed, signed=False) >> (32 - output_bits)
-	item_right = hashed_item_left ^ current_location
-	return (item_left << output_bits) + item_right
-
-def rand_point(bound, i): 
-	'''
-	:param bound: an integer
-	:param i: an integer less than bound
-	:return: a uniform integer from [0, bound - 1], distinct from i
-	'''
-	value = randint(0, bound - 1)
-	while (value == i):
-		value = randint(0, bound - 1)
-	return value	
-
 class Cuckoo():
 
-	def __init__(self, hash_seed):
+	def __init__(self, hash_seed, stash_size=stash_size):
 		self.number_of_bins = 2 ** output_bits
-		self.recursion_depth = int(8 * math.log(self.number_of_bins) / math.log(2))
-		self.data_structure = [None for j in range(self.number_of_bins)]
-		self.insert_index = randint(0, number_of_hashes - 1)
-		self.depth = 0
+		self.recursion_depth = int(8 * math.log(self.number_of_bins) / math.log(2)) # maximum number of evictions for one insertion
+		self.hash_seed = hash_seed
+		self.stash_size = stash_size
 		self.FAIL = 0
 
-		self.hash_seed = hash_seed	
+		# the inserted items, their item_left || 0 values and their number_of_hashes locations, kept in lists which grow with every insertion
+		self.items = []
+		self.item_lefts = []
+		self.locations = []
+		# owners[loc] = item_id * number_of_hashes + index, for the item inserted in loc with the hash of the given index, or -1 if loc is empty
+		self.owners = np.full(self.number_of_bins, -1, dtype=np.int64)
+		# data_structure[loc] = item_left || index for the item in loc, or dummy_msg_client if loc is empty
+		self.data_structure = np.full(self.number_of_bins, dummy_msg_client, dtype=np.int64)
+		# ids of the items which could not be placed after recursion_depth evictions
+		self.stash = []
+
+		# random choices of a new hash for the evicted items, drawn in batches
+		self.random_offsets = []
+
+		# eviction statistics
+		self.evictions = 0
+		self.max_chain_length = 0
+
+	def place(self, item_id, index, owners, data_structure, item_lefts, locations):
+		'''
+		:param item_id: the id of an item, i.e. its position in self.items
+		:param index: the index of the hash used first
+		:param owners, data_structure: the tables to be filled (as lists or NumPy arrays)
+		:param item_lefts, locations: the item_left || 0 values and the locations of all the items (as lists or NumPy arrays)
+		Iterative Cuckoo insertion: after recursion_depth evictions, the item left without a place goes to the stash.
+		'''
+		for chain_length in range(self.recursion_depth + 1):
+			current_location = locations[item_id][index]
+			evicted = owners[current_location]
+			owners[current_location] = item_id * number_of_hashes + index
+			data_structure[current_location] = item_lefts[item_id] + index
+			if evicted < 0:
+				if chain_length > self.max_chain_length:
+					self.max_chain_length = chain_length
+				return
+			self.evictions += 1
+			item_id, unwanted_index = divmod(int(evicted), number_of_hashes)
+			if not self.random_offsets:
+				self.random_offsets = np.random.randint(1, number_of_hashes, size=4096).tolist()
+			index = (unwanted_index + self.random_offsets.pop()) % number_of_hashes
+		self.max_chain_length = self.recursion_depth + 1
+		self.stash.append(item_id)
+		if len(self.stash) > self.stash_size:
+			self.FAIL = 1
 
 	def insert(self, item): #item is an integer
-		current_location = location( self.hash_seed[self.insert_index], item)
-		current_item = self.data_structure[ current_location]
-		self.data_structure[ current_location ] = left_and_index(item, self.insert_index)
-
-		if (current_item == None):
-			self.insert_index = randint(0, number_of_hashes - 1)	
-			self.depth = 0	
-		else:
-			unwanted_index = extract_index(current_item)
-			self.insert_index = rand_point(number_of_hashes, unwanted_index)	
-			if (self.depth < self.recursion_depth):
-				self.depth +=1
-				jumping_item = reconstruct_item(current_item, current_location, self.hash_seed[unwanted_index])
-				self.insert(jumping_item)		
+		item_id = len(self.items)
+		self.items.append(item)
+		self.item_lefts.append((item >> output_bits) << log_no_hashes)
+		self.locations.append([location(seed, item) for seed in self.hash_seed[:number_of_hashes]])
+		self.place(item_id, int(np.random.randint(0, number_of_hashes)), self.owners, self.data_structure, self.item_lefts, self.locations)
+
+	def insert_array(self, items):
+		'''
+		:param items: a NumPy array of distinct integers (in the protocol, the PRFed client set)
+		:return: the number of items that were put in the stash
+		'''
+		stash_before = len(self.stash)
+		items = np.asarray(items, dtype=np.uint64)
+		first_id = len(self.items)
+		self.items.extend(items.tolist())
+		self.item_lefts.extend(((items >> np.uint64(output_bits)).astype(np.int64) << log_no_hashes).tolist())
+		self.locations.extend(np.stack([location_array(seed, items) for seed in self.hash_seed[:number_of_hashes]], axis=1).tolist())
+		first_indices = np.random.randint(0, number_of_hashes, size=len(items)).tolist()
+		# the insertion loop runs on Python lists, which are much faster to index than NumPy arrays
+		owners = self.owners.tolist()
+		data_structure = self.data_structure.tolist()
+		for item_id, index in zip(range(first_id, len(self.items)), first_indices):
+			self.place(item_id, index, owners, data_structure, self.item_lefts, self.locations)
+		self.owners = np.array(owners, dtype=np.int64)
+		self.data_structure = np.array(data_structure, dtype=np.int64)
+		return len(self.stash) - stash_before
+
+	def owner_ids(self, owners):
+		'''
+		:param owners: a NumPy array of entries of owners (or of the owners of an extra query from stash_batches)
+		:return: the ids of the items (their positions in self.items) placed in these locations, or -1 for the empty locations
+		'''
+		return np.where(owners >= 0, owners // number_of_hashes, -1)
+
+	def stashed_items(self):
+		'''
+		:return: the items from the stash; these do not appear in data_structure
+		'''
+		return np.array([self.items[item_id] for item_id in self.stash], dtype=np.uint64)
+
+	def stash_batches(self):
+		'''
+		:return: the extra queries which find the stashed items, as a list of (batch, owners, data_structure) with the owners and data_structure of the poly_modulus_degree
+		bins of the batch, laid out as in the Cuckoo table
+		The server keeps every item in the bins of all its hashes, so each stashed item is placed in only one of its locations, in the first of a few extra tables
+		where one of them is free; every batch of bins of an extra table holding stashed items makes one query.
+		'''
+		tables = []
+		for item_id in self.stash:
+			for owners, data_structure in tables:
+				free = [index for index in range(number_of_hashes) if owners[self.locations[item_id][index]] < 0]
+				if free:
+					break
 			else:
-				self.FAIL = 1	
+				owners, data_structure = np.full(self.number_of_bins, -1, dtype=np.int64), np.full(self.number_of_bins, dummy_msg_client, dtype=np.int64)
+				tables.append((owners, data_structure))
+				free = [0]
+			current_location = self.locations[item_id][free[0]]
+			owners[current_location] = item_id * number_of_hashes + free[0]
+			data_structure[current_location] = self.item_lefts[item_id] + free[0]
+		queries = []
+		for owners, data_structure in tables:
+			for batch in np.unique(np.flatnonzero(owners >= 0) // poly_modulus_degree).tolist():
+				bins = slice(batch * poly_modulus_degree, (batch + 1) * poly_modulus_degree)
+				queries.append((batch, owners[bins], data_structure[bins]))
+		return queries
@@ -0,0 +1,181 @@
+import os
+import json
+import cProfile
+import threading
+from itertools import count as sequence
+from collections import defaultdict
+from contextlib import contextmanager
+from time import time, perf_counter
+from parameters import metrics_directory, metrics_format, profile
+
+# Timers and counters shared by all the scripts of the protocol.
+# The timers add up the seconds spent in each phase (OPRF, hashing, interpolation, power reconstruction, dot products, serialization, network I/O),
+# the counters add up events (homomorphic multiplications, bytes sent and received, Cuckoo evictions, bin overflows, ...).
+# A worker process records into its own Metrics while running a task through measured, and returns them with the result, to be merged by the caller.
+
+class Metrics():
+
+    def __init__(self):
+        self.timers = defaultdict(float) # seconds spent in each phase
+        self.calls = defaultdict(int) # number of times each phase was timed
+        self.counters = defaultdict(int)
+        # the threads of the 'threads' evaluation mode record into the same Metrics
+        self.lock = threading.Lock()
+
+    def reset(self):
+        with self.lock:
+            self.timers.clear()
+            self.calls.clear()
+            self.counters.clear()
+
+    def add_time(self, name, seconds, calls=1):
+        with self.lock:
+            self.timers[name] += seconds
+            self.calls[name] += calls
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    @contextmanager
+    def timer(self, name):
+        '''
+        Adds the wall time of the code run inside the context to the timer name.
+        '''
+        t0 = perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, perf_counter() - t0)
+
+    def snapshot(self):
+        '''
+        :return: the timers, the numbers of calls and the counters, as plain dictionaries (which can be pickled or written as JSON)
+        '''
+        with self.lock:
+            return {'timers': dict(self.timers), 'calls': dict(self.calls), 'counters': dict(self.counters)}
+
+    def merge(self, snapshot):
+        '''
+        :param snapshot: the snapshot of other Metrics, added to these ones
+        '''
+        with self.lock:
+            for name, seconds in snapshot['timers'].items():
+                self.timers[name] += seconds
+            for name, calls in snapshot['calls'].items():
+                self.calls[name] += calls
+            for name, amount in snapshot['counters'].items():
+                self.counters[name] += amount
+
+    def computation_time(self, phases):
+        '''
+        :return: the total seconds of the given phases
+        '''
+        return sum(self.timers.get(name, 0.0) for name in phases)
+
+# the Metrics of this process (replaced while a task runs through measured)
+metrics = Metrics()
+# the Metrics exported so far by this process, for each role, for the cumulative Prometheus counters
+exported_totals = defaultdict(Metrics)
+profile_numbers = sequence()
+
+def timer(name):
+    return metrics.timer(name)
+
+def count(name, amount=1):
+    metrics.count(name, amount)
+
+@contextmanager
+def profiled(name):
+    '''
+    If profile is set, the code run inside the context is profiled with cProfile, and the statistics are written in metrics_directory,
+    in a file named after name and the process; they can be read with pstats or snakeviz.
+    '''
+    if not profile or metrics_directory is None:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        os.makedirs(metrics_directory, exist_ok=True)
+        profiler.dump_stats(os.path.join(metrics_directory, '{}_{}_{}.prof'.format(name, os.getpid(), next(profile_numbers))))
+
+@contextmanager
+def phase(name):
+    '''
+    A top-level phase of a script: timed, and profiled if profile is set.
+    '''
+    with timer(name), profiled(name):
+        yield
+
+def measured(function, *args):
+    '''
+    Runs function(*args) with fresh Metrics, in a worker process.
+    :return: the output of the function and the snapshot of its Metrics
+    '''
+    global metrics
+    previous = metrics
+    metrics = Metrics()
+    try:
+        with profiled(function.__name__):
+            output = function(*args)
+        return output, metrics.snapshot()
+    finally:
+        metrics = previous
+
+def metrics_summary(snapshot):
+    '''
+    :return: a few lines of text with the timers (the slowest first) and the counters of the snapshot
+    '''
+    lines = []
+    for name, seconds in sorted(snapshot['timers'].items(), key=lambda timer: -timer[1]):
+        lines.append('    {:<28} {:9.3f}s  ({} calls)'.format(name, seconds, snapshot['calls'][name]))
+    for name, amount in sorted(snapshot['counters'].items()):
+        lines.append('    {:<28} {:>10}'.format(name, amount))
+    return '\n'.join(lines)
+
+def prometheus_text(role):
+    '''
+    :return: the Prometheus text format of all the Metrics exported by this process for the role
+    '''
+    totals = exported_totals[role].snapshot()
+    lines = ['# TYPE psi_runs_total counter', 'psi_runs_total{{role="{}"}} {}'.format(role, totals['counters'].get('runs', 0)),
+             '# TYPE psi_phase_seconds_total counter']
+    for name, seconds in sorted(totals['timers'].items()):
+        lines.append('psi_phase_seconds_total{{role="{}",phase="{}"}} {!r}'.format(role, name, seconds))
+    lines.append('# TYPE psi_phase_calls_total counter')
+    for name, calls in sorted(totals['calls'].items()):
+        lines.append('psi_phase_calls_total{{role="{}",phase="{}"}} {}'.format(role, name, calls))
+    for name, amount in sorted(totals['counters'].items()):
+        if name != 'runs':
+            lines.append('# TYPE psi_{}_total counter'.format(name))
+            lines.append('psi_{}_total{{role="{}"}} {}'.format(name, role, amount))
+    return '\n'.join(lines) + '\n'
+
+def export_metrics(role, snapshot, **details):
+    '''
+    Writes the snapshot of one run (or of one served client) in metrics_directory, if it is set:
+    with metrics_format 'jsonl', as one more line of {role}_metrics.jsonl (with the given details);
+    with metrics_format 'prometheus', as the cumulative counters of all the runs of this process, in {role}_metrics.prom (for the textfile collector of node_exporter).
+    '''
+    if metrics_directory is None:
+        return
+    os.makedirs(metrics_directory, exist_ok=True)
+    totals = exported_totals[role]
+    totals.merge(snapshot)
+    totals.count('runs')
+    if metrics_format == 'jsonl':
+        record = dict(details, role=role, time=time(), **snapshot)
+        with open(os.path.join(metrics_directory, '{}_metrics.jsonl'.format(role)), 'a') as f:
+            f.write(json.dumps(record) + '\n')
+    elif metrics_format == 'prometheus':
+        # written to a temporary file first, so that the collector never reads a partial file
+        filename = os.path.join(metrics_directory, '{}_metrics.prom'.format(role))
+        with open(filename + '.tmp', 'w') as f:
+            f.write(prometheus_text(role))
+        os.replace(filename + '.tmp', filename)
+    else:
+        raise ValueError('unknown metrics format {}'.format(metrics_format))
@@ -1,12 +1,19 @@
 from fastecdsa.curve import P192
 from fastecdsa.point import Point
-from math import log2
+from fastecdsa import curvemath
+from math import log2, ceil
+from functools import lru_cache
 from multiprocessing import Pool
-from parameters import sigma_max
+import numpy as np
+from parameters import sigma_max, oprf_processes
 
 mask = 2 ** sigma_max - 1
 
-number_of_processes = 4
+number_of_processes = oprf_processes
+# the number of items (or points) sent to a worker process at a time
+chunk_size = 2 ** 12
+# the scalars of the fixed-base multiplications are split into windows of window_bits bits
+window_bits = 8
 
 # Curve parameters
 curve_used = P192
@@ -14,12 +21,146 @@ prime_of_curve_equation = curve_used.p
 order_of_generator = curve_used.q
 log_p = int(log2(prime_of_curve_equation)) + 1
 G = Point(curve_used.gx, curve_used.gy, curve=curve_used) #generator of the curve_used
+number_of_windows = ceil(order_of_generator.bit_length() / window_bits)
+# the curve parameters, as given to the point addition of fastecdsa
+curve_parameters = [str(curve_used.p), str(curve_used.a), str(curve_used.b), str(curve_used.q), str(curve_used.gx), str(curve_used.gy)]
+# the number of bytes of a coordinate of a point on the elliptic curve
+coordinate_bytes = (prime_of_curve_equation.bit_length() + 7) // 8
+
+# the pool of worker processes, created at the first parallel call and kept for the next ones
+pool = None
+
+def get_pool():
+	global pool
+	if pool is None:
+		pool = Pool(number_of_processes)
+	return pool
+
+def chunks(vector):
+	return (vector[i: i + chunk_size] for i in range(0, len(vector), chunk_size))
+
+def parallel_map(function, inputs):
+	'''
+	:param inputs: the inputs of function, one for each chunk
+	:return: the concatenation of the outputs of function, computed by the worker processes and streamed back in order
+	'''
+	final_output = []
+	for output_vector in get_pool().imap(function, inputs):
+		final_output.extend(output_vector)
+	return final_output
+
+@lru_cache(maxsize=4)
+def fixed_base_table(x, y):
+	'''
+	:param x, y: the coordinates of a point P on the elliptic curve
+	:return: a table with the coordinates of d * 2 ** (window_bits * i) * P on position [i][d - 1], as strings
+	'''
+	table = []
+	P = Point(x, y, curve=curve_used)
+	for i in range(number_of_windows):
+		row = []
+		Q = P
+		for d in range(1, 2 ** window_bits):
+			row.append((str(Q.x), str(Q.y)))
+			Q = Q + P
+		table.append(row)
+		# now Q = 2 ** window_bits * P
+		P = Q
+	return table
+
+def fixed_base_multiply(item, table):
+	'''
+	:param item: an integer
+	:param table: the fixed_base_table of a point P
+	:return: the coordinates of item * P, as strings; a sum of one entry of the table for each nonzero window of item
+	'''
+	scalar = item % order_of_generator
+	x, y = '0', '0' # the point at infinity
+	i = 0
+	while scalar:
+		d = scalar & (2 ** window_bits - 1)
+		if d:
+			if x == '0' and y == '0':
+				x, y = table[i][d - 1]
+			else:
+				x, y = curvemath.add(x, y, table[i][d - 1][0], table[i][d - 1][1], *curve_parameters)
+		scalar >>= window_bits
+		i += 1
+	return x, y
+
+def compress_points(vector_of_pairs):
+	'''
+	:param vector_of_pairs: vector of coordinates of some points on the elliptic curve
+	:return: the x coordinates, as big endian integers of coordinate_bytes bytes each, followed by the parities of the y coordinates, packed one bit per point
+	'''
+	xs = b''.join(int(x).to_bytes(coordinate_bytes, 'big') for x, y in vector_of_pairs)
+	parities = np.packbits(np.array([int(y) & 1 for x, y in vector_of_pairs], dtype=np.uint8))
+	return xs + parities.tobytes()
+
+def number_of_compressed_points(data):
+	'''
+	:return: the number n of points in the output data of compress_points, of length n * coordinate_bytes + ceil(n / 8)
+	'''
+	n = 8 * len(data) // (8 * coordinate_bytes + 1)
+	for candidate in (n, n + 1):
+		if candidate * coordinate_bytes + (candidate + 7) // 8 == len(data):
+			return candidate
+	raise ValueError('{} bytes do not hold compressed points'.format(len(data)))
+
+def decompress_points(data):
+	'''
+	:param data: the output of compress_points
+	:return: the vector of coordinates of the points; a ValueError is raised if some x coordinate is not the one of a point on the curve
+	'''
+	n = number_of_compressed_points(data)
+	parities = np.unpackbits(np.frombuffer(data, dtype=np.uint8, offset=n * coordinate_bytes), count=n).tolist()
+	data = memoryview(data)
+	p = prime_of_curve_equation
+	vector_of_pairs = []
+	for k in range(n):
+		x = int.from_bytes(data[k * coordinate_bytes: (k + 1) * coordinate_bytes], 'big')
+		right_side = (x * x * x + curve_used.a * x + curve_used.b) % p
+		# p = 3 (mod 4), so a square root of right_side is right_side ** ((p + 1) / 4), when there is one
+		y = pow(right_side, (p + 1) // 4, p)
+		if x >= p or y * y % p != right_side:
+			raise ValueError('the compressed point number {} is not on the curve'.format(k))
+		if y & 1 != parities[k]:
+			y = p - y
+		vector_of_pairs.append([x, y])
+	return vector_of_pairs
+
+def split_compressed(data, points_per_chunk):
+	'''
+	:param data: the output of compress_points
+	:param points_per_chunk: a multiple of 8
+	:return: the compressed chunks of points_per_chunk consecutive points (the last one may be shorter)
+	'''
+	n = number_of_compressed_points(data)
+	return [data[k * coordinate_bytes: min(k + points_per_chunk, n) * coordinate_bytes] + data[n * coordinate_bytes + k // 8: n * coordinate_bytes + (min(k + points_per_chunk, n) + 7) // 8] for k in range(0, n, points_per_chunk)]
+
+def join_compressed(chunks):
+	'''
+	:param chunks: compressed chunks, with a multiple of 8 points in each chunk except the last one
+	:return: the compressed concatenation of the chunks
+	'''
+	lengths = [number_of_compressed_points(chunk) * coordinate_bytes for chunk in chunks]
+	return b''.join(chunk[:length] for chunk, length in zip(chunks, lengths)) + b''.join(chunk[length:] for chunk, length in zip(chunks, lengths))
+
+def multiply_pairs(key, vector_of_pairs):
+	'''
+	:param vector_of_pairs: vector of coordinates of some points P, already known to be on the curve
+	:return: the coordinates of the points key * P, as strings
+	'''
+	key = str(key)
+	return [curvemath.mul(str(x), str(y), key, *curve_parameters) for x, y in vector_of_pairs]
 
 def server_prf_offline(vector_of_items_and_point): #used as a subroutine for server_prf_offline_paralel
 	vector_of_items = vector_of_items_and_point[0]
 	point = vector_of_items_and_point[1]
-	vector_of_multiples = [item * point for item in vector_of_items]
-	return [(Q.x >> log_p - sigma_max - 10) & mask for Q in vector_of_multiples]
+	# the table of the point is computed once in every worker process
+	table = fixed_base_table(point.x, point.y)
+	vector_of_multiples = [fixed_base_multiply(item, table) for item in vector_of_items]
+	return [(int(x) >> log_p - sigma_max - 10) & mask for x, y in vector_of_multiples]
 
 def server_prf_offline_parallel(vector_of_items, point):
 	'''
@@ -27,76 +168,47 @@ def server_prf_offline_parallel(vector_of_items, point):
 	:param point: a point on elliptic curve (it will be key * G)
 	:return: a sigma_max bits integer from the first coordinate of item * point (this will be the same as item * key * G)
 	'''
-	division = int(len(vector_of_items) / number_of_processes)
-	inputs = [vector_of_items[i * division: (i+1) * division] for i in range(number_of_processes)]
-	if len(vector_of_items) % number_of_processes != 0:
-		inputs.append(vector_of_items[number_of_processes * division: number_of_processes * division + (len(vector_of_items) % number_of_processes)])
-	inputs_and_point = [(input_vec, point) for input_vec in inputs]
-	outputs = []
-	with Pool(number_of_processes) as p:
-		outputs = p.map(server_prf_offline, inputs_and_point)	
-	final_output = []
-	for output_vector in outputs:
-		final_output = final_output + output_vector
-	return final_output		
-
-def server_prf_online(keyed_vector_of_points): #used as a subroutine in server_prf_online_paralel
-	key = keyed_vector_of_points[0]
-	vector_of_points = keyed_vector_of_points[1]
-	vector_of_multiples = [key * PP for PP in vector_of_points]
-	return [[Q.x, Q.y] for Q in vector_of_multiples]
+	return parallel_map(server_prf_offline, ((input_vec, point) for input_vec in chunks(vector_of_items)))
 
+def server_prf_online_compressed(keyed_compressed_points): #used as a subroutine by the online server
+	'''
+	:param keyed_compressed_points: a key and some compressed points P
+	:return: the compressed points key * P
+	'''
+	key = keyed_compressed_points[0]
+	return compress_points(multiply_pairs(key, decompress_points(keyed_compressed_points[1])))
 
-def server_prf_online_parallel(key, vector_of_pairs):
+def server_prf_online_compressed_parallel(key, compressed_points):
 	'''
 	:param key: an integer
-	:param vector_of_pairs: vector of coordinates of some points P on the elliptic curve
-	:return: vector of coordinates of points key * P on the elliptic curve
-	'''
-	vector_of_points = [Point(P[0], P[1], curve=curve_used) for P in vector_of_pairs]
-	division = int(len(vector_of_points) / number_of_processes)
-	inputs = [vector_of_points[i * division: (i+1) * division] for i in range(number_of_processes)]
-	if len(vector_of_points) % number_of_processes != 0:
-		inputs.append(vector_of_points[number_of_processes * division: number_of_processes * division + (len(vector_of_points) % number_of_processes)])
-	keyed_inputs = [(key, _) for _ in inputs]
-	outputs = []
-	with Pool(number_of_processes) as p:
-		outputs = p.map(server_prf_online, keyed_inputs)
-	final_output = []
-	for output_vector in outputs:
-		final_output = final_output + output_vector
-	return final_output
+	:param compressed_points: some compressed points P, as received from the client
+	:return: the compressed points key * P, computed by the worker processes
+	'''
+	return join_compressed(get_pool().map(server_prf_online_compressed, ((key, input_chunk) for input_chunk in split_compressed(compressed_points, chunk_size))))
+
+def client_prf_offline_vector(vector_of_items_and_point): #used as a subroutine for client_prf_offline_parallel
+	vector_of_items = vector_of_items_and_point[0]
+	point = vector_of_items_and_point[1]
+	table = fixed_base_table(point.x, point.y)
+	return [[int(x), int(y)] for x, y in (fixed_base_multiply(item, table) for item in vector_of_items)]
 
-def client_prf_offline(item, point):
+def client_prf_offline_parallel(vector_of_items, point):
 	'''
-	:param item: an integer
-	:param point: a point on elliptic curve  (ex. in the protocol point = key * G)
-	:return: coordinates of item * point (ex. in the protocol it computes key * item * G)
-	'''
-	P = item * point
-	x_item = P.x
-	y_item = P.y
-	return [x_item, y_item]
-
-def client_prf_online(keyed_vector_of_pairs):
-	key_inverse = keyed_vector_of_pairs[0]
-	vector_of_pairs = keyed_vector_of_pairs[1]
-	vector_of_points = [Point(pair[0],pair[1], curve=curve_used) for pair in vector_of_pairs]
-	vector_key_inverse_points = [key_inverse * PP for PP in vector_of_points]
-	return [(Q.x >> log_p - sigma_max - 10) & mask for Q in vector_key_inverse_points]
-
-def client_prf_online_parallel(key_inverse, vector_of_pairs):
-	vector_of_pairs = vector_of_pairs
-	division = int(len(vector_of_pairs) / number_of_processes)
-	inputs = [vector_of_pairs[i * division: (i+1) * division] for i in range(number_of_processes)]
-	if len(vector_of_pairs) % number_of_processes != 0:
-		inputs.append(vector_of_pairs[number_of_processes * division: number_of_processes * division + (len(vector_of_pairs) % number_of_processes)])
-	keyed_inputs = [(key_inverse, _) for _ in inputs]		
-	outputs = []
-	with Pool(number_of_processes) as p:
-		outputs = p.map(client_prf_online, keyed_inputs)
-	final_output = []
-	for output_vector in outputs:
-		final_output = final_output + output_vector
-	return final_output
+	:param vector_of_items: a vector of integers
+	:param point: a point on elliptic curve (ex. in the protocol point = key * G)
+	:return: the coordinates of item * point, for every item
+	'''
+	return parallel_map(client_prf_offline_vector, ((input_vec, point) for input_vec in chunks(vector_of_items)))
 
+def client_prf_online_compressed(keyed_compressed_points): #used as a subroutine by client_prf_online_parallel, on a chunk of the compressed points from the server
+	key_inverse = keyed_compressed_points[0]
+	vector_key_inverse_points = multiply_pairs(key_inverse, decompress_points(keyed_compressed_points[1]))
+	return [(int(x) >> log_p - sigma_max - 10) & mask for x, y in vector_key_inverse_points]
+
+def client_prf_online_parallel(key_inverse, compressed_points):
+	'''
+	:param key_inverse: an integer
+	:param compressed_points: some compressed points P, as received from the server
+	:return: the PRF values, sigma_max bits from the first coordinate of key_inverse * P
+	'''
+	return parallel_map(client_prf_online_compressed, ((key_inverse, input_chunk) for input_chunk in split_compressed(compressed_points, chunk_size)))
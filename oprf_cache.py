@@ -0,0 +1,179 @@
+import os
+import struct
+import hashlib
+import heapq
+import shutil
+import numpy as np
+from parameters import sigma_max
+from oprf import server_prf_offline_parallel, curve_used
+
+# Binary format of the cache of the PRF values of the server items:
+# a header of header_size bytes, followed by the sorted items (count unsigned 64-bit integers) and then their PRF values (count unsigned 64-bit integers).
+# The header records what the PRF values depend on:
+# magic, version, the fingerprint of the PRF (curve and key * G), sigma_max, count
+magic = b'PSIPRF\x00\x00'
+version = 1
+header_format = '<8sI32sIQ'
+header_size = 64
+entry_dtype = np.dtype('<u8')
+
+
+def prf_fingerprint(point):
+    '''
+    :param point: the point key * G used for the PRF
+    :return: a SHA-256 digest of the curve and of the point, which changes when the key or the curve changes
+    '''
+    return hashlib.sha256('{} {} {}'.format(curve_used.name, point.x, point.y).encode()).digest()
+
+def load_cache(filename, fingerprint):
+    '''
+    :param filename: the name of a file written by save_cache
+    :param fingerprint: the prf_fingerprint of the current PRF
+    :return: memory-mapped arrays with the sorted items and their PRF values; empty arrays if there is no cache for the current PRF and sigma_max
+    '''
+    empty = np.zeros(0, dtype=entry_dtype)
+    if not os.path.exists(filename):
+        return empty, empty
+    with open(filename, 'rb') as f:
+        header = f.read(header_size)
+    if len(header) < header_size or header[:len(magic)] != magic:
+        return empty, empty
+    file_magic, file_version, file_fingerprint, file_sigma_max, count = struct.unpack(header_format, header[:struct.calcsize(header_format)])
+    if file_version != version or file_fingerprint != fingerprint or file_sigma_max != sigma_max or count == 0:
+        return empty, empty
+    entries = np.memmap(filename, dtype=entry_dtype, mode='r', offset=header_size, shape=(2, count))
+    return entries[0], entries[1]
+
+def save_cache(filename, fingerprint, items, values):
+    '''
+    :param items: a sorted array of distinct items, in [0, 2 ** 64)
+    :param values: their PRF values
+    The cache is written to a temporary file first, so that an interrupted run leaves the previous cache intact.
+    '''
+    header = struct.pack(header_format, magic, version, fingerprint, sigma_max, len(items))
+    temporary = filename + '.tmp'
+    with open(temporary, 'wb') as f:
+        f.write(header.ljust(header_size, b'\x00'))
+        f.write(np.ascontiguousarray(items, dtype=entry_dtype).tobytes())
+        f.write(np.ascontiguousarray(values, dtype=entry_dtype).tobytes())
+    os.replace(temporary, filename)
+
+def lookup(cached_items, cached_values, items):
+    '''
+    :param cached_items, cached_values: the arrays returned by load_cache
+    :param items: a sorted array of distinct items
+    :return: the PRF values of the items found in the cache (0 for the others) and a boolean array telling which items were found
+    '''
+    # the cached items are found by binary search in the memory-mapped sorted items
+    positions = np.searchsorted(cached_items, items)
+    found = positions < len(cached_items)
+    found[found] = cached_items[positions[found]] == items[found]
+    values = np.zeros(len(items), dtype=np.uint64)
+    values[found] = cached_values[positions[found]]
+    return values, found
+
+def cached_prf(vector_of_items, point, filename):
+    '''
+    :param vector_of_items: a vector of integers
+    :param point: a point on elliptic curve (it will be key * G)
+    :param filename: the file of the cache
+    :return: the NumPy array of the PRF values of the items (as in server_prf_offline_parallel) and the number of items found in the cache.
+    Only the items missing from the cache go through the PRF; then the cache is replaced by one holding exactly the given items.
+    Items of 64 bits or more are never cached.
+    '''
+    fingerprint = prf_fingerprint(point)
+    cached_items, cached_values = load_cache(filename, fingerprint)
+    large_items = [item for item in vector_of_items if item >= 2 ** 64 or item < 0]
+    items = np.unique(np.fromiter((item for item in vector_of_items if 0 <= item < 2 ** 64), dtype=np.uint64))
+
+    values, found = lookup(cached_items, cached_values, items)
+    missing = items[~found].tolist()
+    values[~found] = np.array(server_prf_offline_parallel(missing, point), dtype=np.uint64)
+    large_values = np.array(server_prf_offline_parallel(large_items, point), dtype=np.uint64)
+
+    del cached_items, cached_values
+    save_cache(filename, fingerprint, items, values)
+    return np.concatenate([values, large_values]), int(found.sum())
+
+class Streamed_cache:
+    '''
+    The cache for a set which is read chunk by chunk: prf is called for every chunk, then close replaces the cache by one holding exactly the items of all the chunks.
+    The chunks are kept on disk as sorted runs, which close merges into the new cache, so the memory used does not depend on the size of the set.
+    '''
+    def __init__(self, point, filename, merge_block=2 ** 12):
+        '''
+        :param point: a point on elliptic curve (it will be key * G)
+        :param filename: the file of the cache
+        :param merge_block: the number of entries of every run kept in memory while merging
+        '''
+        self.point = point
+        self.filename = filename
+        self.merge_block = merge_block
+        self.fingerprint = prf_fingerprint(point)
+        self.cached_items, self.cached_values = load_cache(filename, self.fingerprint)
+        self.runs = open(filename + '.runs', 'wb')
+        self.run_lengths = []
+        self.hits = 0
+
+    def prf(self, items):
+        '''
+        :param items: a sorted NumPy array of distinct items, in [0, 2 ** 64)
+        :return: the NumPy array of their PRF values; only the items missing from the cache go through the PRF
+        '''
+        values, found = lookup(self.cached_items, self.cached_values, items)
+        values[~found] = np.array(server_prf_offline_parallel(items[~found].tolist(), self.point), dtype=np.uint64)
+        self.hits += int(found.sum())
+        # a run is the items of the chunk followed by their values
+        self.runs.write(np.ascontiguousarray(items, dtype=entry_dtype).tobytes())
+        self.runs.write(np.ascontiguousarray(values, dtype=entry_dtype).tobytes())
+        self.run_lengths.append(len(items))
+        return values
+
+    def run_entries(self, runs, start, length):
+        '''
+        :return: a generator of the (item, value) pairs of the run starting at the entry start of runs, merge_block entries at a time
+        '''
+        for k in range(0, length, self.merge_block):
+            end = min(length, k + self.merge_block)
+            yield from zip(runs[start + k: start + end].tolist(), runs[start + length + k: start + length + end].tolist())
+
+    def close(self):
+        '''
+        Merges the runs into the new cache, keeping one entry per item; the cache is written to temporary files first, as in save_cache.
+        '''
+        self.runs.close()
+        del self.cached_items, self.cached_values
+        runs_filename = self.filename + '.runs'
+        temporary = self.filename + '.tmp'
+        values_filename = self.filename + '.values'
+        count = 0
+        with open(temporary, 'wb') as items_file, open(values_filename, 'wb') as values_file:
+            items_file.write(bytes(header_size))
+            if self.run_lengths:
+                runs = np.memmap(runs_filename, dtype=entry_dtype, mode='r')
+                starts = np.cumsum([0] + [2 * length for length in self.run_lengths[:-1]]).tolist()
+                merged = heapq.merge(*[self.run_entries(runs, start, length) for start, length in zip(starts, self.run_lengths)])
+                previous = None
+                items, values = [], []
+                for item, value in merged:
+                    if item == previous:
+                        continue
+                    previous = item
+                    items.append(item)
+                    values.append(value)
+                    if len(items) == self.merge_block:
+                        items_file.write(np.array(items, dtype=entry_dtype).tobytes())
+                        values_file.write(np.array(values, dtype=entry_dtype).tobytes())
+                        count += len(items)
+                        items, values = [], []
+                items_file.write(np.array(items, dtype=entry_dtype).tobytes())
+                values_file.write(np.array(values, dtype=entry_dtype).tobytes())
+                count += len(items)
+                del runs
+        with open(temporary, 'r+b') as f, open(values_filename, 'rb') as values_file:
+            f.write(struct.pack(header_format, magic, version, self.fingerprint, sigma_max, count).ljust(header_size, b'\x00'))
+            f.seek(0, os.SEEK_END)
+            shutil.copyfileobj(values_file, f)
+        os.replace(temporary, self.filename)
+        os.remove(values_filename)
+        os.remove(runs_filename)
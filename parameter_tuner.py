@@ -0,0 +1,141 @@
+import argparse
+import json
+import numpy as np
+import tenseal as ts
+from math import log2, ceil
+from time import time
+
+import parameters
+from bin_capacity_estimator import bin_capacity
+from auxiliary_functions import flat_plan, paterson_stockmeyer_plan, window_exponents
+
+# Searches output_bits, alpha, ell and the evaluation engine for the sizes of the sets,
+# predicts the latency of the online server and the communication of each setting with a cost model calibrated on this machine,
+# and writes the best parameter set to a JSON file, to be used by setting the environment variable PSI_PARAMETERS to its name.
+
+# the Cuckoo table of the client should be at most this full
+max_cuckoo_load = 0.5
+# the number of extra output_bits tried, above the smallest one that fits the client set
+extra_output_bits = 2
+max_alpha = 64
+max_ell = 4
+engines = ['flat', 'paterson_stockmeyer']
+
+
+def calibrate(poly_modulus_degree, plain_modulus, repetitions=10):
+    '''
+    :return: a cost model measured with TenSEAL: the seconds of a ciphertext-ciphertext multiplication, of a ciphertext-plaintext multiplication,
+    of a ciphertext addition, and the bytes of a serialized ciphertext
+    '''
+    context = ts.context(ts.SCHEME_TYPE.BFV, poly_modulus_degree=poly_modulus_degree, plain_modulus=plain_modulus)
+    vector = np.random.randint(0, plain_modulus, poly_modulus_degree)
+    x = ts.bfv_vector(context, vector.tolist())
+    y = ts.bfv_vector(context, vector.tolist())
+
+    def measure(operation):
+        t0 = time()
+        for i in range(repetitions):
+            operation()
+        return (time() - t0) / repetitions
+
+    return {'ciphertext_multiplication': measure(lambda: x * y),
+            'plaintext_multiplication': measure(lambda: x * vector),
+            'addition': measure(lambda: x + y),
+            'ciphertext_bytes': len(x.serialize())}
+
+def evaluation_plan(engine, ell, minibin_capacity, alpha, he_depth):
+    '''
+    :return: the (ciphertext-ciphertext multiplications, depth) of one query batch, or None if the engine needs more than he_depth
+    '''
+    try:
+        if engine == 'paterson_stockmeyer':
+            baby_steps, levels, multiplications, depth = paterson_stockmeyer_plan(ell, minibin_capacity, alpha, max_depth=he_depth)
+        else:
+            levels, multiplications, depth = flat_plan(ell, minibin_capacity, max_depth=he_depth)
+    except ValueError:
+        return None
+    return multiplications, depth
+
+def predict(cost_model, number_of_batches, alpha, minibin_capacity, ell, multiplications):
+    '''
+    :return: the predicted seconds of the online server (on one core) and the bytes of the query and of the answer
+    '''
+    seconds_per_batch = multiplications * cost_model['ciphertext_multiplication'] + alpha * minibin_capacity * (cost_model['plaintext_multiplication'] + cost_model['addition'])
+    ciphertexts_per_batch = len(window_exponents(ell, minibin_capacity)) + alpha
+    return number_of_batches * seconds_per_batch, number_of_batches * ciphertexts_per_batch * cost_model['ciphertext_bytes']
+
+def validate(parameter_set):
+    '''
+    Raises a ValueError if the parameter set cannot be used by the offline and online scripts.
+    '''
+    output_bits = parameter_set['output_bits']
+    poly_modulus_degree = parameter_set['poly_modulus_degree']
+    plain_modulus = parameter_set['plain_modulus']
+    alpha = parameter_set['alpha']
+    if (2 ** output_bits) % poly_modulus_degree != 0:
+        raise ValueError('2 ** output_bits = {} is not a multiple of poly_modulus_degree = {}'.format(2 ** output_bits, poly_modulus_degree))
+    if plain_modulus % (2 * poly_modulus_degree) != 1:
+        raise ValueError('plain_modulus = {} is not 1 modulo 2 * poly_modulus_degree'.format(plain_modulus))
+    if parameter_set['bin_capacity'] % alpha != 0:
+        raise ValueError('bin_capacity = {} is not a multiple of alpha = {}'.format(parameter_set['bin_capacity'], alpha))
+    if parameter_set['bin_capacity'] < bin_capacity(parameter_set['server_size'], output_bits, parameters.number_of_hashes):
+        raise ValueError('bin_capacity = {} is too small for {} server items'.format(parameter_set['bin_capacity'], parameter_set['server_size']))
+    if parameter_set['client_size'] > max_cuckoo_load * 2 ** output_bits:
+        raise ValueError('{} bins are too few for {} client items'.format(2 ** output_bits, parameter_set['client_size']))
+    if int(log2(plain_modulus)) + output_bits - (int(log2(parameters.number_of_hashes)) + 1) > 64:
+        raise ValueError('the PRF values of sigma_max bits do not fit in 64 bits')
+    if evaluation_plan(parameter_set['evaluation_engine'], parameter_set['ell'], parameter_set['bin_capacity'] // alpha, alpha, parameter_set['he_depth']) is None:
+        raise ValueError('the {} evaluation needs more than depth {}'.format(parameter_set['evaluation_engine'], parameter_set['he_depth']))
+
+def tune(server_size, client_size, bandwidth, cost_model):
+    '''
+    :param bandwidth: the bandwidth between the client and the server, in bits per second
+    :return: the parameter set with the lowest predicted latency (online server time plus transfer time of the query and answer) and its predictions
+    '''
+    poly_modulus_degree = parameters.poly_modulus_degree
+    smallest_output_bits = max(int(log2(poly_modulus_degree)), ceil(log2(client_size / max_cuckoo_load)))
+    best = None
+    for output_bits in range(smallest_output_bits, smallest_output_bits + extra_output_bits + 1):
+        number_of_batches = 2 ** output_bits // poly_modulus_degree
+        capacity = bin_capacity(server_size, output_bits, parameters.number_of_hashes)
+        for alpha in range(1, min(max_alpha, capacity) + 1):
+            minibin_capacity = -(-capacity // alpha)
+            for ell in range(1, max_ell + 1):
+                for engine in engines:
+                    plan = evaluation_plan(engine, ell, minibin_capacity, alpha, parameters.he_depth)
+                    if plan is None:
+                        continue
+                    seconds, communication = predict(cost_model, number_of_batches, alpha, minibin_capacity, ell, plan[0])
+                    latency = seconds + 8 * communication / bandwidth
+                    if best is None or latency < best[0]:
+                        parameter_set = {'server_size': server_size, 'client_size': client_size, 'output_bits': output_bits,
+                                         'plain_modulus': parameters.plain_modulus, 'poly_modulus_degree': poly_modulus_degree,
+                                         'bin_capacity': alpha * minibin_capacity, 'alpha': alpha, 'ell': ell,
+                                         'he_depth': parameters.he_depth, 'evaluation_engine': engine}
+                        best = (latency, parameter_set, seconds, communication, plan)
+    if best is None:
+        raise ValueError('no parameter set fits the HE depth {}'.format(parameters.he_depth))
+    return best
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Chooses the PSI parameters with the lowest predicted online latency.')
+    parser.add_argument('--server-size', type=int, default=parameters.server_size)
+    parser.add_argument('--client-size', type=int, default=parameters.client_size)
+    parser.add_argument('--bandwidth', type=float, default=10 ** 8, help='bits per second between the client and the server')
+    parser.add_argument('--output', default='psi_parameters.json')
+    arguments = parser.parse_args()
+
+    cost_model = calibrate(parameters.poly_modulus_degree, parameters.plain_modulus)
+    print('Cost model: {:.2f} ms per ciphertext multiplication, {:.2f} ms per plaintext multiplication, {:.2f} ms per addition, {} bytes per ciphertext'.format(
+        1000 * cost_model['ciphertext_multiplication'], 1000 * cost_model['plaintext_multiplication'], 1000 * cost_model['addition'], cost_model['ciphertext_bytes']))
+
+    latency, parameter_set, seconds, communication, (multiplications, depth) = tune(arguments.server_size, arguments.client_size, arguments.bandwidth, cost_model)
+    # the client decides the size of the intersection in set_gen.py; keep it below the size of the client set
+    parameter_set['intersection_size'] = min(parameters.intersection_size, parameter_set['client_size'])
+    validate(parameter_set)
+    with open(arguments.output, 'w') as f:
+        json.dump(parameter_set, f, indent=4)
+    print(json.dumps(parameter_set, indent=4))
+    print('Predicted online server time {:.2f}s (one core, {} ciphertext multiplications per batch at depth {}), query and answer {:.2f} MB'.format(seconds, multiplications, depth, communication / 2 ** 20))
+    print('Run the offline and online scripts with PSI_PARAMETERS={}'.format(arguments.output))
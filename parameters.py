@@ -1,4 +1,6 @@
 from math import log2
+import os
+import json
 
 # sizes of databases of server and client
 # size of intersection should be less than size of client's database
@@ -10,7 +12,7 @@ intersection_size = 3500
 hash_seeds = [123456789, 10111213141516, 17181920212223]
 
 # output_bits = number of bits of output of the hash functions
-# number of bins for simple/Cuckoo Hashing = 2 ** output_bits
+# number of bins for simple/Cuckoo Hashing = 2 ** output_bits, a multiple of poly_modulus_degree
 output_bits = 13
 
 # encryption parameters of the BFV scheme: the plain modulus and the polynomial modulus degree
@@ -20,11 +22,9 @@ poly_modulus_degree = 2 ** 13
 # the number of hashes we use for simple/Cuckoo hashing
 number_of_hashes = 3
 
-# length of the database items
-sigma_max = int(log2(plain_modulus)) + output_bits - (int(log2(number_of_hashes)) + 1) 
-
-# B = [68, 176, 536, 1832, 6727] for log(server_size) = [16, 18, 20, 22, 24]
-bin_capacity = 536
+# B = [68, 176, 536, 1832, 6727] for log(server_size) = [16, 18, 20, 22, 24]; see bin_capacity_estimator.py
+# bin_capacity is B rounded up to a multiple of alpha, since the bins are split into alpha minibins of the same capacity
+bin_capacity = 544
 
 # partitioning parameter
 alpha = 16
@@ -32,3 +32,88 @@ alpha = 16
 # windowing parameter
 ell = 2
 
+# multiplicative depth supported by the BFV parameters, for the homomorphic evaluation of the server
+# (the multiplications by the plaintext coefficients also take one level)
+he_depth = 3
+
+
+# maximum number of client items that may be left out of the Cuckoo table (in its stash) before Cuckoo hashing fails; the stashed items are queried in extra batches
+stash_size = 8
+
+# number of server items read, PRFed and simple hashed at a time by server_offline.py
+ingestion_chunk_size = 2 ** 16
+
+# number of worker processes for the OPRF computations (kept alive between calls)
+oprf_processes = os.cpu_count()
+
+# online server: number of worker processes (for the OPRF layer and the homomorphic evaluation) and maximum number of clients served at the same time
+server_workers = os.cpu_count()
+max_concurrent_clients = 2 * server_workers
+
+# sharded online server: with server_shards > 0, the batches of bins are split among server_shards shard processes (at most number_of_batches of them),
+# each reading only its part of the preprocessed database and answering with shard_workers worker processes (by default server_workers // server_shards,
+# set below, so that the shards share the cores); server_online.py runs the OPRF layer and forwards the query of every batch to its shard as soon as it arrives,
+# through the Unix sockets of shard_socket_directory
+server_shards = 0
+shard_socket_directory = '/tmp'
+
+# memory (in MB) that the online server may use, in total, to keep the columns of the preprocessed database batch-encoded as SEAL plaintexts
+# (in NTT form, i.e. poly_modulus_degree 64 bits integers per prime of the coefficient modulus, for the columns multiplying the powers of the query);
+# every worker process keeps its own plaintexts, so it gets an equal share of it (the server_workers processes, or the shard_workers processes of every shard);
+# the columns beyond it are encoded again for every query
+plaintext_cache_mb = 256
+
+# how the online server evaluates the alpha minibin polynomials of a query (and reconstructs the powers of the query):
+# 'serial', 'threads' (evaluation_threads threads in the process serving the query) or 'processes' (the minibins spread over the server_workers processes,
+# each one rebuilding the powers of the query from its window, and keeping the contexts of the last max_concurrent_clients clients deserialized)
+evaluation_mode = 'processes'
+evaluation_threads = server_workers
+
+# how the online server evaluates each minibin polynomial on the powers of the query:
+# 'flat' (with all the powers Enc(y), ..., Enc(y ** minibin_capacity)) or 'paterson_stockmeyer' (with fewer baby step and giant step powers, shared by the alpha minibins)
+evaluation_engine = 'flat'
+
+# the answers of the online server (see answer_compression.py): with answer_compression, every answer ciphertext is switched down to the smallest coefficient modulus
+# that keeps answer_noise_margin bits of noise budget before being sent; with answer_packing = k > 1, the server multiplies together the answers of k minibins
+# (the product vanishes if one of them does) and sends alpha / k ciphertexts per batch, at the cost of log2(k) levels of the multiplicative depth he_depth
+answer_compression = True
+answer_noise_margin = 2
+answer_packing = 1
+
+# instrumentation (see instrumentation.py): if metrics_directory is set, the timers and counters of every run, and of every client served, are written there,
+# in metrics_format 'jsonl' (one JSON object per line) or 'prometheus' (text format); with profile = True, the cProfile statistics of every phase are written there too
+metrics_directory = None
+metrics_format = 'jsonl'
+profile = False
+
+# the parameters listed in the JSON file named by the environment variable PSI_PARAMETERS (for example written by parameter_tuner.py) replace the ones above
+tunable_parameters = ['server_size', 'client_size', 'intersection_size', 'output_bits', 'plain_modulus', 'poly_modulus_degree', 'bin_capacity', 'alpha', 'ell', 'he_depth', 'evaluation_engine', 'answer_compression', 'answer_packing', 'server_shards', 'metrics_directory', 'metrics_format', 'profile']
+if os.environ.get('PSI_PARAMETERS'):
+    with open(os.environ['PSI_PARAMETERS']) as f:
+        tuned_parameters = json.load(f)
+    unknown_parameters = set(tuned_parameters) - set(tunable_parameters)
+    if unknown_parameters:
+        raise ValueError('{} sets unknown parameters: {}'.format(os.environ['PSI_PARAMETERS'], ', '.join(sorted(unknown_parameters))))
+    globals().update(tuned_parameters)
+
+# only the bin_capacity // alpha * alpha first places of a bin would be covered by the minibin polynomials
+if bin_capacity % alpha != 0:
+    raise ValueError('bin_capacity = {} is not a multiple of alpha = {}'.format(bin_capacity, alpha))
+
+# the bins are split into batches of poly_modulus_degree bins; each batch is queried with its own ciphertexts
+if 2 ** output_bits < poly_modulus_degree or 2 ** output_bits % poly_modulus_degree != 0:
+    raise ValueError('2 ** output_bits = {} is not a positive multiple of poly_modulus_degree = {}'.format(2 ** output_bits, poly_modulus_degree))
+number_of_batches = 2 ** output_bits // poly_modulus_degree
+
+# the worker processes of every shard of the sharded online server
+shard_workers = max(1, server_workers // server_shards) if server_shards > 0 else server_workers
+
+# the number of batches whose query the client sends before reading their answers, and that the server (and every shard) holds at the same time:
+# one per shard with the sharded online server, so that all the shards work at the same time, and one otherwise
+in_flight_batches = min(server_shards, number_of_batches) if server_shards > 0 else 1
+
+# the number of ciphertexts of the answer to each batch
+answer_ciphertexts = alpha // answer_packing
+
+# length of the database items
+sigma_max = int(log2(plain_modulus)) + output_bits - (int(log2(number_of_hashes)) + 1) 
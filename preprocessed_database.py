@@ -0,0 +1,60 @@
+import struct
+import numpy as np
+from parameters import plain_modulus, alpha, bin_capacity, output_bits
+
+# Binary format of the preprocessed server database:
+# a header of header_size bytes, followed by a matrix of unsigned integers stored column by column (column-major),
+# so that the server can memory-map the file and read each column of coefficients without copying it.
+# The header records the parameters the matrix was computed with:
+# magic, version, bytes per entry, plain_modulus, alpha, bin_capacity, output_bits, number of rows, number of columns
+magic = b'PSIDB\x00\x00\x00'
+version = 1
+header_format = '<8sIIQIIIQQ'
+header_size = 64
+
+
+def entry_dtype(bytes_per_entry):
+    return np.dtype('<u{}'.format(bytes_per_entry))
+
+def save_database(filename, matrix):
+    '''
+    :param filename: the name of the file to be written
+    :param matrix: a 2D array of integers in [0, 2 ** 64); in the protocol, the (number_of_bins, alpha * (minibin_capacity + 1)) coefficients matrix
+    Writes the matrix column by column, after a header with the current parameters.
+    '''
+    rows, columns = matrix.shape
+    bytes_per_entry = 4 if plain_modulus < 2 ** 32 and matrix.max(initial=0) < 2 ** 32 else 8
+    header = struct.pack(header_format, magic, version, bytes_per_entry, plain_modulus, alpha, bin_capacity, output_bits, rows, columns)
+    with open(filename, 'wb') as f:
+        f.write(header.ljust(header_size, b'\x00'))
+    stored_columns = np.memmap(filename, dtype=entry_dtype(bytes_per_entry), mode='r+', offset=header_size, shape=(columns, rows))
+    stored_columns[:] = matrix.T
+    stored_columns.flush()
+    del stored_columns
+
+def read_header(filename):
+    '''
+    :param filename: the name of a file written by save_database
+    :return: a dictionary with the fields of the header of the file
+    '''
+    with open(filename, 'rb') as f:
+        header = f.read(header_size)
+    if len(header) < header_size or header[:len(magic)] != magic:
+        raise ValueError('{} is not a preprocessed server database'.format(filename))
+    fields = struct.unpack(header_format, header[:struct.calcsize(header_format)])
+    keys = ['magic', 'version', 'bytes_per_entry', 'plain_modulus', 'alpha', 'bin_capacity', 'output_bits', 'rows', 'columns']
+    return dict(zip(keys, fields))
+
+def load_database(filename, mode='r'):
+    '''
+    :param filename: the name of a file written by save_database
+    :param mode: the memory-mapping mode, 'r' (read only) or 'r+' (read and write)
+    :return: a memory-mapped array of shape (columns, rows) with the columns of the stored matrix; nothing is read from disk until it is used
+    '''
+    header = read_header(filename)
+    if header['version'] != version:
+        raise ValueError('{} has format version {}, expected version {}'.format(filename, header['version'], version))
+    for name, value in [('plain_modulus', plain_modulus), ('alpha', alpha), ('bin_capacity', bin_capacity), ('output_bits', output_bits)]:
+        if header[name] != value:
+            raise ValueError('{} was preprocessed with {} = {}, but the parameters have {} = {}'.format(filename, name, header[name], name, value))
+    return np.memmap(filename, dtype=entry_dtype(header['bytes_per_entry']), mode=mode, offset=header_size, shape=(header['columns'], header['rows']))
@@ -0,0 +1,376 @@
+import secrets
+from parameters import plain_modulus, poly_modulus_degree, number_of_batches, bin_capacity, alpha, hash_seeds, answer_compression, answer_ciphertexts, ingestion_chunk_size, in_flight_batches
+from instrumentation import timer, phase, count
+
+# The library API of the protocol: a PSIServer and a PSIClient, with explicit offline and online methods working on in-memory data.
+# They keep their state (OPRF key, HE context, preprocessed database) between queries, and the OPRF worker processes stay alive in oprf.py,
+# so one process can answer (or make) many queries. The scripts of the protocol use them with their fixed filenames.
+# TenSEAL, fastecdsa and the modules using them are imported when first needed, so importing this module is cheap.
+
+minibin_capacity = int(bin_capacity / alpha)
+
+
+def random_key():
+    '''
+    :return: a random OPRF key, in range(1, order_of_generator)
+    '''
+    from oprf import order_of_generator
+    return 1 + secrets.randbelow(order_of_generator - 1)
+
+class PSIServer():
+
+    def __init__(self, key=None):
+        '''
+        :param key: the OPRF key of the server; a random key if None
+        '''
+        self.key = random_key() if key is None else key
+        # the columns of the coefficients of the minibin polynomials, and the file they were loaded from or saved to (if any)
+        self.database = None
+        self.database_filename = None
+        # the simple hashing table, needed to update the database (see server_update.py)
+        self.hashed_data = None
+
+    def offline(self, items, cache_filename=None):
+        '''
+        :param items: the server set, as integers
+        :param cache_filename: the file of the cache of the PRF values (see oprf_cache.py), or None to compute the PRF of all the items
+        :return: the number of entries that did not fit in their bins (0 unless simple hashing failed)
+        '''
+        import numpy as np
+        from oprf import order_of_generator, G, server_prf_offline_parallel
+        from simple_hash import Simple_hash
+
+        # key * generator of elliptic curve
+        point = (self.key % order_of_generator) * G
+        with phase('oprf'):
+            if cache_filename is None:
+                PRFed_items = server_prf_offline_parallel(list(items), point)
+            else:
+                # Only the items which are not in the cache of the previous run (made with the same key and curve) go through the PRF
+                from oprf_cache import cached_prf
+                PRFed_items, cached = cached_prf(items, point, cache_filename)
+                count('oprf_cache_hits', cached)
+            PRFed_items = np.unique(np.asarray(PRFed_items, dtype=np.uint64))
+        count('server_items', len(items))
+
+        # The OPRF-processed database entries are simple hashed, all at once
+        with phase('simple_hashing'):
+            SH = Simple_hash(hash_seeds)
+            overflow = int(SH.insert_array(PRFed_items).sum())
+        count('bin_overflows', overflow)
+        self.preprocess(SH)
+        return overflow
+
+    def offline_stream(self, filename, cache_filename=None, chunk_items=ingestion_chunk_size):
+        '''
+        :param filename: the file of the server set, in the binary format of set_files.py or as text, with items in [0, 2 ** 64)
+        :param cache_filename: the file of the cache of the PRF values (see oprf_cache.py), or None to compute the PRF of all the items
+        :param chunk_items: the number of items read, PRFed and simple hashed at a time
+        :return: the number of entries that did not fit in their bins (0 unless simple hashing failed)
+        Apart from the simple hashing table and the coefficients, whose sizes only depend on the parameters, the memory used depends on chunk_items, not on the size of the set.
+        The items repeated in the set (or with the same PRF value) are only inserted once: the simple hashing table skips the items it already holds,
+        found with a Bloom filter of the inserted items and a look up in their bins.
+        '''
+        import numpy as np
+        from oprf import order_of_generator, G, server_prf_offline_parallel
+        from simple_hash import Simple_hash
+        from set_files import read_item_chunks
+
+        # key * generator of elliptic curve
+        point = (self.key % order_of_generator) * G
+        if cache_filename is not None:
+            from oprf_cache import Streamed_cache
+            cache = Streamed_cache(point, cache_filename)
+        SH = Simple_hash(hash_seeds, deduplicate=True)
+        overflow = 0
+        for items in read_item_chunks(filename, chunk_items):
+            count('server_items', len(items))
+            items = np.unique(items)
+            with phase('oprf'):
+                if cache_filename is None:
+                    PRFed_items = np.array(server_prf_offline_parallel(items.tolist(), point), dtype=np.uint64)
+                else:
+                    PRFed_items = cache.prf(items)
+            # Each chunk of OPRF-processed entries is simple hashed as soon as it is ready
+            with phase('simple_hashing'):
+                overflow += int(SH.insert_array(np.unique(PRFed_items)).sum())
+        if cache_filename is not None:
+            with phase('oprf'):
+                cache.close()
+            count('oprf_cache_hits', cache.hits)
+        count('bin_overflows', overflow)
+        self.preprocess(SH)
+        return overflow
+
+    def preprocess(self, SH):
+        '''
+        :param SH: the Simple_hash table of the PRFed server set
+        '''
+        import numpy as np
+        from auxiliary_functions import coeffs_from_minibins
+
+        # Each bin is partitioned into alpha minibins, represented by the coefficients of the polynomial vanishing in their entries
+        # The columns of the coefficients are kept contiguous, as in the files of preprocessed_database
+        with phase('interpolation'):
+            self.database = np.ascontiguousarray(coeffs_from_minibins(SH.minibins(alpha), plain_modulus).T)
+        self.database_filename = None
+        self.hashed_data = SH.simple_hashed_data
+
+    def save(self, database='server_preprocessed', hashed='server_hashed'):
+        '''
+        Writes the preprocessed database and the simple hashing table, in the binary format of preprocessed_database.
+        '''
+        from preprocessed_database import save_database
+        with phase('saving'):
+            save_database(database, self.database.T)
+            if self.hashed_data is not None:
+                save_database(hashed, self.hashed_data.T)
+        self.database_filename = database
+
+    def load(self, database='server_preprocessed'):
+        '''
+        Memory-maps the preprocessed database written by save; nothing is read from disk until it is used.
+        '''
+        from preprocessed_database import load_database
+        self.database = load_database(database)
+        self.database_filename = database
+
+    def oprf(self, compressed_points):
+        '''
+        :param compressed_points: the encoded client set, as compressed points P on the elliptic curve
+        :return: the compressed points key * P
+        '''
+        from oprf import server_prf_online_compressed_parallel
+        with timer('oprf'):
+            return server_prf_online_compressed_parallel(self.key, compressed_points)
+
+    def answer(self, context_serialized, window_serialized, batch):
+        '''
+        :param context_serialized: the serialized public HE context of the client
+        :param window_serialized: the serialized ciphertexts of the windowed query of the client, for the given batch of bins
+        :return: the serialized answer for the batch (answer_ciphertexts ciphertexts), computed in this process
+        '''
+        import server_online
+        server_online.load_server_database(self.database)
+        with timer('query'):
+            return server_online.answer_query(context_serialized, window_serialized, batch)
+
+    def serve(self, host='localhost', port=4470, ready=None):
+        '''
+        Serves the clients over the network, with server_workers worker processes, until interrupted.
+        :param ready: a threading.Event, set once the server is listening
+        '''
+        import asyncio
+        import server_online
+        # the worker processes memory-map the file of the database if there is one, and receive a copy of the array otherwise
+        database = self.database if self.database_filename is None else self.database_filename
+        asyncio.run(server_online.main(ready, database, self.key, host, port))
+
+class PSIClient():
+
+    def __init__(self, key=None):
+        '''
+        :param key: the OPRF key of the client; a random key if None
+        '''
+        self.key = random_key() if key is None else key
+        # the HE contexts, created for the first query
+        self.private_context = None
+        self.public_context_serialized = None
+        # the client set and its encoding as compressed points, from the offline phase
+        self.items = None
+        self.encoded_items = None
+        # the PRF values of the items, their Cuckoo table and its windowing, from the last query
+        self.PRFed_items = None
+        self.cuckoo = None
+        self.windowed_table = None
+        # the queries of the last intersection, as (batch, owners, windowed rows) for the bins of the batch: one per batch, then the extra ones for the Cuckoo stash
+        self.queries = []
+        # the bytes exchanged with the server during the last intersect_remote
+        self.communication = {}
+
+    def context(self):
+        '''
+        :return: the private HE context, created at the first call and reused by the next queries
+        '''
+        if self.private_context is None:
+            import tenseal as ts
+            # Setting the public and private contexts for the BFV Homorphic Encryption scheme
+            with phase('context_generation'):
+                self.private_context = ts.context(ts.SCHEME_TYPE.BFV, poly_modulus_degree=poly_modulus_degree, plain_modulus=plain_modulus)
+                public_context = ts.context_from(self.private_context.serialize())
+                public_context.make_context_public()
+                self.public_context_serialized = public_context.serialize()
+        return self.private_context
+
+    def offline(self, items):
+        '''
+        :param items: the client set, as integers
+        :return: the encoded client set, as compressed points on the elliptic curve, ready to be sent to the server
+        '''
+        from oprf import client_prf_offline_parallel, compress_points, order_of_generator, G
+        # key * generator of elliptic curve
+        point = (self.key % order_of_generator) * G
+        self.items = list(items)
+        with phase('oprf'):
+            self.encoded_items = compress_points(client_prf_offline_parallel(self.items, point))
+        count('client_items', len(self.items))
+        return self.encoded_items
+
+    def load(self, items, encoded_items):
+        '''
+        :param items: the client set
+        :param encoded_items: the output of offline for these items (with the same key), for example read from a file
+        '''
+        self.items = list(items)
+        self.encoded_items = encoded_items
+
+    def finish_oprf(self, oprf_answer):
+        '''
+        :param oprf_answer: the answer of the server to the encoded client set, i.e. the compressed points multiplied by its key
+        :return: the Cuckoo table of the PRF values of the items
+        A RuntimeError is raised if more than stash_size items were left in the stash of the Cuckoo table.
+        '''
+        from oprf import order_of_generator, client_prf_online_parallel
+        from cuckoo_hash import Cuckoo
+        from auxiliary_functions import batched_windowing
+        # We finalize the OPRF processing by applying the inverse of the key
+        # the compressed points are decompressed (and checked to be on the curve) by the OPRF worker processes
+        with phase('oprf'):
+            key_inverse = pow(self.key, -1, order_of_generator)
+            self.PRFed_items = client_prf_online_parallel(key_inverse, oprf_answer)
+        # Each PRFed item from the client set is mapped to a Cuckoo hash table; the empty places hold dummy messages
+        with phase('cuckoo_hashing'):
+            self.cuckoo = Cuckoo(hash_seeds)
+            self.cuckoo.insert_array(self.PRFed_items)
+        count('cuckoo_evictions', self.cuckoo.evictions)
+        count('cuckoo_stash', len(self.cuckoo.stash))
+        if self.cuckoo.FAIL:
+            raise RuntimeError('Cuckoo hashing failed: {} items in the stash, more than stash_size = {}'.format(len(self.cuckoo.stash), self.cuckoo.stash_size))
+        # The windowing procedure is applied to all the bins at once: row k holds the powers y ** window_exponents[k] of the items y of the bins
+        with phase('windowing'):
+            self.windowed_table = batched_windowing(self.cuckoo.data_structure, minibin_capacity, plain_modulus)
+            # The bins of the Cuckoo structure are split into batches of poly_modulus_degree bins
+            self.queries = []
+            for batch in range(number_of_batches):
+                bins = slice(batch * poly_modulus_degree, (batch + 1) * poly_modulus_degree)
+                self.queries.append((batch, self.cuckoo.owners[bins], self.windowed_table[:, bins]))
+            # the stashed items are found by a few extra queries, for the batches of bins where they are placed in extra tables
+            for batch, owners, data_structure in self.cuckoo.stash_batches():
+                self.queries.append((batch, owners, batched_windowing(data_structure, minibin_capacity, plain_modulus)))
+        count('stash_queries', len(self.queries) - number_of_batches)
+        return self.cuckoo
+
+    def query(self, k):
+        '''
+        :return: a generator of the serialized ciphertexts of the k-th query (of self.queries), in the order of window_exponents
+        '''
+        import tenseal as ts
+        private_context = self.context()
+
+        # The <<batched>> query of the batch is made of one ciphertext per windowed row, produced one at a time
+        for window_row in self.queries[k][2]:
+            with timer('encryption'):
+                encrypted_query = ts.bfv_vector(private_context, window_row)
+            with timer('serialization'):
+                ciphertext = encrypted_query.serialize()
+            count('query_ciphertexts')
+            count('query_ciphertext_bytes', len(ciphertext))
+            yield ciphertext
+
+    def recover(self, k, answers):
+        '''
+        :param answers: the answer_ciphertexts serialized (and possibly compressed) ciphertexts of the answer of the server to the k-th query (an iterable, decrypted as they come)
+        :return: the client items found in the batch of bins of the query
+        '''
+        import numpy as np
+        from answer_compression import decrypt_answer
+        private_context = self.context()
+        decryptions = []
+        for answer in answers:
+            count('answer_ciphertexts')
+            count('answer_ciphertext_bytes', len(answer))
+            # the answers are SEAL ciphertexts, switched to a smaller coefficient modulus if answer_compression
+            with timer('decryption'):
+                decryption, saved = decrypt_answer(private_context, bytes(answer))
+            if answer_compression:
+                # the server counts the exact answer_bytes_saved
+                count('answer_bytes_saved_estimate', saved)
+            decryptions.append(decryption)
+
+        with phase('recovery'):
+            # the bins of the batch where the polynomial of one of the minibins of the server vanishes
+            hits = np.flatnonzero((np.array(decryptions, dtype=np.int64) == 0).any(axis=0))
+            # the items placed in these bins by Cuckoo hashing; an empty bin only vanishes by accident, with probability about 1 / plain_modulus
+            item_ids = self.cuckoo.owner_ids(self.queries[k][1][hits])
+            return [self.items[k] for k in item_ids[item_ids >= 0].tolist()]
+
+    def intersect(self, server):
+        '''
+        :param server: a PSIServer in this process
+        :return: the intersection of the client set with the set of the server
+        '''
+        self.finish_oprf(server.oprf(self.encoded_items))
+        self.context()
+        intersection = []
+        for k, (batch, owners, windowed_rows) in enumerate(self.queries):
+            intersection.extend(self.recover(k, server.answer(self.public_context_serialized, list(self.query(k)), batch)))
+        return intersection
+
+    def intersect_remote(self, host='localhost', port=4470):
+        '''
+        Runs the online phase with the server listening on (host, port): the queries for the batches of bins, at most in_flight_batches of them ahead of their answers.
+        :return: the intersection of the client set with the set of the server
+        '''
+        import socket
+        import numpy as np
+        from communication import Frame_receiver, send_frame, frame_header, oprf_query_frame, oprf_answer_frame, context_frame, stash_batches_frame, query_frame, answer_frame
+        self.context()
+        communication = {'oprf_sent': 0, 'oprf_received': 0, 'query_sent': 0, 'answer_received': 0}
+
+        def receive(frame_type, direction):
+            # the time spent waiting for the answers includes the computation of the server
+            with timer('network_receive'):
+                payload = receiver.receive(frame_type)
+            communication[direction] += frame_header.size + len(payload)
+            return payload
+
+        def send(frame_type, payload, direction):
+            with timer('network_send'):
+                communication[direction] += send_frame(client, frame_type, payload)
+
+        client = socket.create_connection((host, port))
+        try:
+            # the frames are sent as soon as they are written
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            # the payloads of the received frames go into a buffer, which is reused
+            receiver = Frame_receiver(client)
+
+            send(oprf_query_frame, self.encoded_items, 'oprf_sent')
+            self.finish_oprf(bytes(receive(oprf_answer_frame, 'oprf_received')))
+
+            # The public context is sent once, before the batches of the query, followed by the batches of the extra queries for the Cuckoo stash
+            send(context_frame, self.public_context_serialized, 'query_sent')
+            send(stash_batches_frame, np.array([batch for batch, owners, windowed_rows in self.queries[number_of_batches:]], dtype='<u8').tobytes(), 'query_sent')
+            # The answers come in the order of the queries
+            # Each of the answer_ciphertexts ciphertexts of the answer is decrypted as soon as its frame arrives
+            intersection = []
+
+            def read_answer(k):
+                intersection.extend(self.recover(k, (receive(answer_frame, 'answer_received') for j in range(answer_ciphertexts))))
+
+            # The query for a batch is sent once the answers to all but in_flight_batches - 1 of the previous ones are read: without shards, the answer to every batch
+            # comes before the next one is sent; with shards, the shards work on the batches at the same time
+            for k in range(len(self.queries)):
+                # Each ciphertext is sent in its own frame as soon as it is encrypted
+                for ciphertext in self.query(k):
+                    send(query_frame, ciphertext, 'query_sent')
+                if k + 1 >= in_flight_batches:
+                    read_answer(k + 1 - in_flight_batches)
+            for k in range(max(0, len(self.queries) + 1 - in_flight_batches), len(self.queries)):
+                read_answer(k)
+        finally:
+            client.close()
+        count('bytes_sent', communication['oprf_sent'] + communication['query_sent'])
+        count('bytes_received', communication['oprf_received'] + communication['answer_received'])
+        self.communication = communication
+        return intersection
@@ -1,67 +1,34 @@
-from parameters import sigma_max, number_of_hashes, output_bits, bin_capacity, alpha, hash_seeds, plain_modulus
-from simple_hash import Simple_hash
-from auxiliary_functions import coeffs_from_roots
-from math import log2
-import pickle
-from oprf import server_prf_offline_parallel, order_of_generator, G
-from time import time
+from psi import PSIServer
+from set_files import has_64_bit_items, read_items
+from instrumentation import metrics, metrics_summary, export_metrics
 
 #server's PRF secret key
 oprf_server_key = 1234567891011121314151617181920
 
-# key * generator of elliptic curve
-server_point_precomputed = (oprf_server_key % order_of_generator) * G
+# the scripts may run one after the other in the same process (as in benchmark.py), so the Metrics start empty
+metrics.reset()
 
-server_set = []
-f = open('server_set', 'r')
-lines = f.readlines()
-for item in lines:
-    server_set.append(int(item[:-1]))
-
-t0 = time()
-#The PRF function is applied on the set of the server, using parallel computation
-PRFed_server_set = server_prf_offline_parallel(server_set, server_point_precomputed)
-PRFed_server_set = set(PRFed_server_set)
-t1 = time()
-
-log_no_hashes = int(log2(number_of_hashes)) + 1
-dummy_msg_server = 2 ** (sigma_max - output_bits + log_no_hashes) + 1 
-server_size = len(server_set)
-minibin_capacity = int(bin_capacity / alpha)
-number_of_bins = 2 ** output_bits
-
-# The OPRF-processed database entries are simple hashed
-SH = Simple_hash(hash_seeds)
-for item in PRFed_server_set:
-    for i in range(number_of_hashes):
-        SH.insert(item, i)
-
-# simple_hashed_data is padded with dummy_msg_server
-for i in range(number_of_bins):
-    for j in range(bin_capacity):
-        if SH.simple_hashed_data[i][j] == None:
-            SH.simple_hashed_data[i][j] = dummy_msg_server
-
-# Here we perform the partitioning:
-# Namely, we partition each bin into alpha minibins with B/alpha items each
+# The set of the server is read from server_set (written by set_gen.py, or a text file) ingestion_chunk_size items at a time, if its items fit in 64 bits
+# The PRF function is applied on each chunk, using parallel computation
+# Only the items which are not in the cache of the previous run (made with the same key and curve) go through the PRF
+# Then the OPRF-processed database entries are simple hashed as they come, and each bin is partitioned into alpha minibins with B/alpha items each
 # We represent each minibin as the coefficients of a polynomial of degree B/alpha that vanishes in all the entries of the mininbin
 # Therefore, each minibin will be represented by B/alpha + 1 coefficients; notice that the leading coeff = 1
-t2 = time()
-
-poly_coeffs = []
-for i in range(number_of_bins):
-    # we create a list of coefficients of all minibins from concatenating the list of coefficients of each minibin
-    coeffs_from_bin = []
-    for j in range(alpha):
-        roots = [SH.simple_hashed_data[i][minibin_capacity * j + r] for r in range(minibin_capacity)]
-        coeffs_from_bin = coeffs_from_bin + coeffs_from_roots(roots, plain_modulus).tolist()
-    poly_coeffs.append(coeffs_from_bin)
-
-f = open('server_preprocessed', 'wb')
-pickle.dump(poly_coeffs, f)
-f.close()
-t3 = time()
-#print('OPRF preprocessing time {:.2f}s'.format(t1 - t0))
-#print('Hashing time {:.2f}s'.format(t2 - t1))
-#print('Poly coefficients from roots time {:.2f}s'.format(t3 - t2))
-print('Server OFFLINE time {:.2f}s'.format(t3 - t0))
+server = PSIServer(oprf_server_key)
+if has_64_bit_items('server_set'):
+    bin_overflow = server.offline_stream('server_set', cache_filename='server_oprf_cache')
+else:
+    # a text set may hold any item below the order of the curve; the items of more than 64 bits cannot be streamed, so the set is read whole
+    print('server_set has items of more than 64 bits: it is read whole')
+    bin_overflow = server.offline(read_items('server_set'), cache_filename='server_oprf_cache')
+print('{} of the {} items were found in the OPRF cache'.format(metrics.counters['oprf_cache_hits'], metrics.counters['server_items']))
+if bin_overflow > 0:
+    print('Simple hashing aborted: {} entries did not fit in their bins'.format(bin_overflow))
+
+# The coefficients are stored column by column, in the binary format of preprocessed_database
+# The simple hashing table is kept (with its bins stored contiguously) for updating the database with server_update.py
+server.save('server_preprocessed', 'server_hashed')
+print('Server OFFLINE time {:.2f}s'.format(metrics.computation_time(['oprf', 'simple_hashing', 'interpolation', 'saving'])))
+snapshot = metrics.snapshot()
+print(metrics_summary(snapshot))
+export_metrics('server_offline', snapshot)
@@ -1,108 +1,722 @@
-import socket
-import tenseal as ts
-import pickle
+import os
+import asyncio
+import hashlib
+import multiprocessing
+from collections import OrderedDict, deque
 import numpy as np
-from math import log2
+import tenseal as ts
+import tenseal.sealapi as sealapi
+from math import log2, ceil
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
-from parameters import number_of_hashes, bin_capacity, alpha, ell
-from auxiliary_functions import power_reconstruct
-from oprf import server_prf_online_parallel
+from parameters import number_of_hashes, plain_modulus, bin_capacity, alpha, ell, poly_modulus_degree, number_of_batches, server_workers, max_concurrent_clients, server_shards, shard_workers, in_flight_batches, shard_socket_directory, plaintext_cache_mb, evaluation_mode, evaluation_threads, he_depth, evaluation_engine, answer_compression, answer_packing, answer_ciphertexts
+from auxiliary_functions import flat_plan, paterson_stockmeyer_plan, power_reconstruct_cost, window_exponents
+from oprf import server_prf_online_compressed, split_compressed, join_compressed, number_of_compressed_points
+from preprocessed_database import load_database
+from answer_compression import serialize_answer
+from communication import read_frame, write_frame, frame_header, oprf_query_frame, oprf_answer_frame, context_frame, query_frame, answer_frame, shard_batch_frame, stash_batches_frame, batch_index
+from instrumentation import Metrics, timer, count, measured, metrics_summary, export_metrics
 
 oprf_server_key = 1234567891011121314151617181920
-from time import time
 
 log_no_hashes = int(log2(number_of_hashes)) + 1
-base = 2 ** ell
 minibin_capacity = int(bin_capacity / alpha)
-logB_ell = int(log2(minibin_capacity) / ell) + 1 # <= 2 ** HE.depth
-
-serv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-serv.bind(('localhost', 4470))
-serv.listen(1)
-
-g = open('server_preprocessed', 'rb')
-poly_coeffs = pickle.load(g)
-
-# For the online phase of the server, we need to use the columns of the preprocessed database
-transposed_poly_coeffs = np.transpose(poly_coeffs).tolist()
-
-for i in range(1):
-    conn, addr = serv.accept()
-    L = conn.recv(10).decode().strip()
-    L = int(L, 10)
-    # OPRF layer: the server receives the encoded set elements as curve points
-    encoded_client_set_serialized = b""
-    while len(encoded_client_set_serialized) < L:
-        data = conn.recv(4096)
-        if not data: break
-        encoded_client_set_serialized += data   
-    encoded_client_set = pickle.loads(encoded_client_set_serialized)
-    t0 = time()
-    # The server computes (parallel computation) the online part of the OPRF protocol, using its own secret key
-    PRFed_encoded_client_set = server_prf_online_parallel(oprf_server_key, encoded_client_set)
-    PRFed_encoded_client_set_serialized = pickle.dumps(PRFed_encoded_client_set, protocol=None)
-    L = len(PRFed_encoded_client_set_serialized)
-    sL = str(L) + ' ' * (10 - len(str(L))) #pad len to 10 bytes
-
-    conn.sendall((sL).encode())
-    conn.sendall(PRFed_encoded_client_set_serialized)    
-    print(' * OPRF layer done!')
-    t1 = time()
-    L = conn.recv(10).decode().strip()
-    L = int(L, 10)
-
-    # The server receives bytes that represent the public HE context and the query ciphertext
-    final_data = b""
-    while len(final_data) < L:
-        data = conn.recv(4096)
-        if not data: break
-        final_data += data
-
-    t2 = time()    
-    # Here we recover the context and ciphertext received from the received bytes
-    received_data = pickle.loads(final_data)
-    srv_context = ts.context_from(received_data[0])
-    received_enc_query_serialized = received_data[1]
-    received_enc_query = [[None for j in range(logB_ell)] for i in range(base - 1)]
-    for i in range(base - 1):
-        for j in range(logB_ell):
-            if ((i + 1) * base ** j - 1 < minibin_capacity):
-                received_enc_query[i][j] = ts.bfv_vector_from(srv_context, received_enc_query_serialized[i][j])
-    
+
+if alpha % answer_packing != 0:
+    raise ValueError('answer_packing = {} does not divide alpha = {}'.format(answer_packing, alpha))
+# the minibins whose answers are multiplied together into one ciphertext of the answer, and the depth taken by these products
+answer_groups = [list(range(k, k + answer_packing)) for k in range(0, alpha, answer_packing)]
+packing_depth = int(ceil(log2(answer_packing)))
+
+if evaluation_engine == 'paterson_stockmeyer':
+    # the plan for computing the baby steps Enc(y), ..., Enc(y^{baby_steps - 1}) and the giant steps Enc(y^{baby_steps}), Enc(y^{2 * baby_steps}), ...
+    baby_steps, power_levels, evaluation_multiplications, evaluation_depth = paterson_stockmeyer_plan(ell, minibin_capacity, alpha, max_depth=he_depth - packing_depth)
+    giant_steps = -(-(minibin_capacity + 1) // baby_steps)
+elif evaluation_engine == 'flat':
+    # the plan for computing the powers Enc(y), ..., Enc(y^{minibin_capacity}) from the windowed query, with shared products
+    power_levels, evaluation_multiplications, evaluation_depth = flat_plan(ell, minibin_capacity, max_depth=he_depth - packing_depth)
+else:
+    raise ValueError('unknown evaluation engine {}'.format(evaluation_engine))
+
+# the exponents of the powers Enc(y ** exponent) sent by the client, in the order of the query frames
+window = window_exponents(ell, minibin_capacity)
+
+# in the 'processes' evaluation mode, every worker process keeps the deserialized public contexts of the last max_concurrent_clients clients it worked for,
+# keyed by a digest of the serialized contexts
+client_contexts = OrderedDict()
+# the number of worker processes the 'processes' evaluation mode splits the work of a query among: server_workers, or shard_workers in a shard process
+evaluation_workers = server_workers
+
+# the columns of the preprocessed database, loaded once by every worker process
+transposed_poly_coeffs = None
+# what the columns were loaded from: the name and modification time of the file, or the array itself
+database_source = None
+# the batches of bins served by this process: all of them, or the ones of its shard
+loaded_batches = range(number_of_batches)
+# plaintext_cache[row, batch] is the part of the row of transposed_poly_coeffs for the batch, batch-encoded as a SEAL plaintext once for all the queries
+plaintext_cache = {}
+# every worker process keeps its own plaintext_cache, so plaintext_cache_mb is split among them: the server_workers ones, or the shard_workers ones of every shard
+caching_processes = min(server_shards, number_of_batches) * shard_workers if server_shards > 0 else server_workers
+
+def database_version(database):
+    if isinstance(database, str):
+        return (database, os.stat(database).st_mtime_ns)
+    return database
+
+def load_server_database(database='server_preprocessed', encode_plaintexts=True, batches=None):
+    '''
+    :param database: the name of a file written by save_database, or the columns of the preprocessed database as an array
+    :param encode_plaintexts: whether to fill plaintext_cache
+    :param batches: the batches of bins to be served (a range), or None for all of them; only their parts of the columns are read and encoded
+    Nothing is done if the same database (the same array, or the same unmodified file) is already loaded for the same batches.
+    '''
+    global transposed_poly_coeffs, database_source, loaded_batches
+    version = database_version(database)
+    batches = range(number_of_batches) if batches is None else batches
+    # arrays are only compared by identity; files by name and modification time
+    same_source = database_source == version if isinstance(database_source, tuple) and isinstance(version, tuple) else database_source is version
+    if database_source is not None and same_source and loaded_batches == batches:
+        return
+    # For the online phase of the server, we need to use the columns of the preprocessed database
+    # They are stored contiguously, so they are memory-mapped and read from disk only when used
+    if isinstance(database, str):
+        transposed_poly_coeffs = load_database(database)
+    else:
+        transposed_poly_coeffs = database
+    database_source = version
+    loaded_batches = batches
+    plaintext_cache.clear()
+    if encode_plaintexts:
+        encode_plaintext_cache()
+
+def refresh_server_database():
+    '''
+    Loads the file of the database again if it was modified since it was loaded (for example by server_update.py), so that plaintext_cache is never stale.
+    '''
+    if isinstance(database_source, tuple):
+        load_server_database(database_source[0], batches=loaded_batches)
+
+@lru_cache(maxsize=None)
+def encoding_context():
+    '''
+    :return: a SEAL context with the encryption parameters of the clients (TenSEAL uses the default coefficient modulus for poly_modulus_degree),
+    for encoding the plaintexts independently of the clients
+    '''
+    parms = sealapi.EncryptionParameters(sealapi.SCHEME_TYPE.BFV)
+    parms.set_poly_modulus_degree(poly_modulus_degree)
+    parms.set_coeff_modulus(sealapi.CoeffModulus.BFVDefault(poly_modulus_degree, sealapi.SEC_LEVEL_TYPE.TC128))
+    parms.set_plain_modulus(sealapi.Modulus(plain_modulus))
+    return sealapi.SEALContext(parms, True, sealapi.SEC_LEVEL_TYPE.TC128)
+
+@lru_cache(maxsize=None)
+def encoding_tools():
+    '''
+    :return: the batch encoder and the evaluator of encoding_context, built once for all the columns
+    '''
+    context = encoding_context()
+    return sealapi.BatchEncoder(context), sealapi.Evaluator(context)
+
+@lru_cache(maxsize=None)
+def coefficient_forms():
+    '''
+    :return: a dictionary with the exponents e whose coefficients are used by the evaluation engine, and for each of them whether its coefficients
+    multiply a power of the query (then they are kept in NTT form, like the powers they multiply) or are added to an evaluation
+    '''
+    if evaluation_engine == 'flat':
+        # the coefficients of y ** minibin_capacity are all 1
+        forms = {e: True for e in range(1, minibin_capacity)}
+        forms[0] = False
+        return forms
+    forms = {}
+    for g in range(giant_steps):
+        first = g * baby_steps
+        for b in range(1, min(baby_steps, minibin_capacity + 1 - first)):
+            forms[first + b] = True
+        forms[first] = g > 0 and min(baby_steps, minibin_capacity + 1 - first) == 1
+    return forms
+
+def plaintext_bytes(ntt):
+    '''
+    :return: the size of a plaintext: poly_modulus_degree 64 bits integers, for each prime of the coefficient modulus of the ciphertexts in NTT form
+    '''
+    primes = len(encoding_context().first_context_data().parms().coeff_modulus()) if ntt else 1
+    return 8 * poly_modulus_degree * primes
+
+def cached_columns(batches):
+    '''
+    :return: the columns (row, batch) kept in plaintext_cache for the batches, batch by batch, up to the share of plaintext_cache_mb MB of plaintexts of this process
+    '''
+    forms = coefficient_forms()
+    budget = plaintext_cache_mb * 2 ** 20 // caching_processes
+    columns = []
+    for batch in batches:
+        for i in range(alpha):
+            for e, ntt in forms.items():
+                budget -= plaintext_bytes(ntt)
+                if budget < 0:
+                    return columns
+                columns.append(((minibin_capacity + 1) * i + minibin_capacity - e, batch))
+    return columns
+
+def encode_column(row, batch):
+    '''
+    :return: the part of the row of transposed_poly_coeffs for the batch, batch-encoded as a SEAL plaintext, in NTT form if it multiplies the powers of the query
+    '''
+    encoder, evaluator = encoding_tools()
+    plaintext = sealapi.Plaintext()
+    column = transposed_poly_coeffs[row, batch * poly_modulus_degree: (batch + 1) * poly_modulus_degree]
+    encoder.encode(np.asarray(column, dtype=np.uint64).tolist(), plaintext)
+    if coefficient_forms()[minibin_capacity - row % (minibin_capacity + 1)]:
+        evaluator.transform_to_ntt_inplace(plaintext, encoding_context().first_parms_id())
+    return plaintext
+
+def encode_plaintext_cache():
+    '''
+    Encodes the columns of the database used by the evaluation engine, batch by batch, as SEAL plaintexts, until plaintext_cache holds the share of plaintext_cache_mb MB of this process.
+    Every query then multiplies and adds them without encoding them again.
+    '''
+    with timer('plaintext_encoding'):
+        for row, batch in cached_columns(loaded_batches):
+            plaintext_cache[row, batch] = encode_column(row, batch)
+
+def oprf_layer(compressed_points, key=oprf_server_key):
+    '''
+    :param compressed_points: some compressed points P on the elliptic curve
+    :return: the compressed points key * P
+    '''
+    count('oprf_points', number_of_compressed_points(compressed_points))
+    return server_prf_online_compressed((key, compressed_points))
+
+def split(sequence, number_of_parts):
+    division = max(1, -(-len(sequence) // number_of_parts))
+    return [sequence[k: k + division] for k in range(0, len(sequence), division)]
+
+def window_from_query(srv_context, window_serialized):
+    '''
+    :param srv_context: the public HE context of a client
+    :param window_serialized: the serialized ciphertexts Enc(y ** exponent) of the windowed query of the client, for one batch of bins, following window_exponents
+    :return: a list with Enc(y ** (k + 1)) on position k, for the exponents that are in the window, and None for the missing exponents
+    '''
+    # Here we recover the ciphertexts from the received bytes
+    with timer('deserialization'):
+        all_powers = [None for i in range(minibin_capacity)]
+        for exponent, ciphertext in zip(window, window_serialized):
+            all_powers[exponent - 1] = ts.bfv_vector_from(srv_context, ciphertext)
+    return all_powers
+
+def coefficients(i, e, batch):
+    '''
+    :return: the column of the coefficients of y ** e in the polynomials of the i-th minibins, for the bins of the given batch,
+    encoded as a SEAL plaintext (taken from plaintext_cache if it is there), in NTT form if coefficient_forms says so
+    '''
+    row = (minibin_capacity + 1) * i + minibin_capacity - e
+    plaintext = plaintext_cache.get((row, batch))
+    if plaintext is not None:
+        return plaintext
+    return encode_column(row, batch)
+
+class Query_powers():
+    '''
+    The powers Enc(y ** k) of a query, as SEAL ciphertexts evaluated with the SEAL evaluator of the context of the client.
+    The powers are also transformed to NTT form once for all the minibins, so that a multiplication by the NTT form of a plaintext is a pointwise product,
+    and the sums of these products are transformed back once.
+    '''
+
+    def __init__(self, all_powers):
+        '''
+        :param all_powers: a list with Enc(y ** (k + 1)) on position k (a BFVVector), for the exponents needed by the evaluation engine, and None for the others
+        '''
+        context = next(power for power in all_powers if power is not None).context()
+        self.seal_context = context.seal_context().data
+        self.evaluator = sealapi.Evaluator(self.seal_context)
+        self.relin_keys = context.relin_keys().data
+        self.ciphertexts = {k + 1: power.ciphertext()[0] for k, power in enumerate(all_powers) if power is not None}
+        if any(list(ciphertext.parms_id()) != list(encoding_context().first_parms_id()) for ciphertext in self.ciphertexts.values()):
+            raise ValueError('the query does not use the encryption parameters of the server')
+        self.ntt_ciphertexts = {}
+        for k, ciphertext in self.ciphertexts.items():
+            self.ntt_ciphertexts[k] = sealapi.Ciphertext()
+            self.evaluator.transform_to_ntt(ciphertext, self.ntt_ciphertexts[k])
+
+    def multiply_plain(self, k, plaintext, product=None):
+        '''
+        :param plaintext: a plaintext in NTT form
+        :param product: a ciphertext in NTT form, or None
+        :return: Enc(y ** k) * plaintext in NTT form, added to product if it is given
+        '''
+        term = sealapi.Ciphertext()
+        self.evaluator.multiply_plain(self.ntt_ciphertexts[k], plaintext, term)
+        if product is None:
+            return term
+        self.evaluator.add_inplace(product, term)
+        return product
+
+    def from_ntt(self, ciphertext, plaintext=None):
+        '''
+        :return: the ciphertext transformed back from NTT form (in place), plus the plaintext if it is given (not in NTT form)
+        '''
+        self.evaluator.transform_from_ntt_inplace(ciphertext)
+        if plaintext is not None:
+            self.evaluator.add_plain_inplace(ciphertext, plaintext)
+        return ciphertext
+
+    def multiply(self, a, b):
+        '''
+        :return: the relinearized product of the ciphertexts a and b
+        '''
+        product = sealapi.Ciphertext()
+        self.evaluator.multiply(a, b, product)
+        self.evaluator.relinearize_inplace(product, self.relin_keys)
+        return product
+
+    def add(self, a, b):
+        '''
+        :return: a + b, computed in a
+        '''
+        if a is None:
+            return b
+        self.evaluator.add_inplace(a, b)
+        return a
+
+def flat_evaluation(powers, i, batch):
+    '''
+    :param powers: the Query_powers with Enc(y ** k), for every exponent k up to minibin_capacity
+    :return: the dot product between the coefficients of the i-th minibins and the powers
+    '''
+    # the coefficients of y ** minibin_capacity are all 1
+    count('plaintext_multiplications', minibin_capacity - 1)
+    # the sum is accumulated in place, in NTT form, starting from a copy of the highest power
+    dot_product = sealapi.Ciphertext()
+    powers.evaluator.transform_to_ntt(powers.ciphertexts[minibin_capacity], dot_product)
+    for e in range(minibin_capacity - 1, 0, -1):
+        powers.multiply_plain(e, coefficients(i, e, batch), dot_product)
+    return powers.from_ntt(dot_product, coefficients(i, 0, batch))
+
+def paterson_stockmeyer_evaluation(powers, i, batch):
+    '''
+    :param powers: the Query_powers with Enc(y ** k), for the baby step and giant step exponents k
+    :return: the evaluation of the polynomials of the i-th minibins, as the sum over g of Enc(y ** (g * baby_steps)) * B_g(y),
+    where B_g(y) is computed with plaintext multiplications of the baby steps
+    '''
+    evaluation = None
+    for g in range(giant_steps):
+        first = g * baby_steps
+        inner = None
+        for b in range(1, min(baby_steps, minibin_capacity + 1 - first)):
+            inner = powers.multiply_plain(b, coefficients(i, first + b, batch), inner)
+        count('plaintext_multiplications', max(0, min(baby_steps, minibin_capacity + 1 - first) - 1))
+        if g == 0:
+            term = powers.from_ntt(inner, coefficients(i, 0, batch))
+        elif inner is None:
+            count('plaintext_multiplications')
+            term = powers.from_ntt(powers.multiply_plain(first, coefficients(i, first, batch)))
+        else:
+            count('ciphertext_multiplications')
+            term = powers.multiply(powers.from_ntt(inner, coefficients(i, first, batch)), powers.ciphertexts[first])
+        evaluation = powers.add(evaluation, term)
+    return evaluation
+
+def evaluate_minibins(powers, i, batch):
+    '''
+    :return: the evaluation of the polynomials of the i-th minibins on the Query_powers, with the evaluation engine, as a SEAL ciphertext
+    '''
+    if evaluation_engine == 'paterson_stockmeyer':
+        return paterson_stockmeyer_evaluation(powers, i, batch)
+    return flat_evaluation(powers, i, batch)
+
+def pack_answers(powers, answers):
+    '''
+    :return: the product of the answers, computed as a balanced tree of log2(len(answers)) levels; it vanishes exactly where one of the answers does
+    '''
+    while len(answers) > 1:
+        count('ciphertext_multiplications', len(answers) // 2)
+        answers = [powers.multiply(answers[k], answers[k + 1]) if k + 1 < len(answers) else answers[k] for k in range(0, len(answers), 2)]
+    return answers[0]
+
+def minibin_answers(powers, groups, batch):
+    '''
+    :param powers: the Query_powers with Enc(y ** k), for the exponents needed by the evaluation engine
+    :param groups: some groups of answer_groups, i.e. lists of answer_packing indices of minibins
+    :param batch: the index of the batch of bins of the powers
+    :return: for every group, the product of the evaluations of the polynomials of its minibins, for the bins of the batch, serialized (and compressed)
+    '''
+    answers = []
+    for group in groups:
+        with timer('dot_products'):
+            answer = pack_answers(powers, [evaluate_minibins(powers, i, batch) for i in group])
+        # each answer is serialized by the thread or process that computed it
+        with timer('answer_compression' if answer_compression else 'serialization'):
+            serialized, saved = serialize_answer(answer, powers.seal_context)
+        count('answer_bytes_saved', saved)
+        answers.append(serialized)
+    return answers
+
+def multiply_powers(all_powers, steps):
+    '''
+    :return: the products Enc(y ** a) * Enc(y ** b) for the steps (k, a, b) of the power plan
+    '''
+    count('ciphertext_multiplications', len(steps))
+    return [all_powers[a - 1] * all_powers[b - 1] for k, a, b in steps]
+
+def reconstruct_powers(all_powers, parallel_map=map):
+    '''
+    Computes the missing powers of all_powers level by level, following the power plan; the products of one level are independent, and split by parallel_map.
+    '''
+    with timer('power_reconstruction'):
+        for steps in power_levels:
+            products = [product for part in parallel_map(lambda part: multiply_powers(all_powers, part), split(steps, evaluation_threads)) for product in part]
+            for (k, a, b), product in zip(steps, products):
+                all_powers[k - 1] = product
+
+def answer_query(context_serialized, window_serialized, batch):
+    '''
+    :param context_serialized: the serialized public HE context of a client
+    :param window_serialized: the serialized encrypted (windowed) query of the client, for the given batch of bins
+    :return: the serialized answer of the server for the batch, i.e. the alpha encrypted evaluations of the minibin polynomials (multiplied answer_packing at a time)
+    In the 'threads' evaluation mode, the products of each level of the power plan and the minibins are split among evaluation_threads threads.
+    '''
+    refresh_server_database()
+    if evaluation_mode == 'threads':
+        pool = ThreadPoolExecutor(evaluation_threads)
+        parallel_map = pool.map
+    else:
+        parallel_map = map
+
     # Here we recover all the encrypted powers Enc(y), Enc(y^2), Enc(y^3) ..., Enc(y^{minibin_capacity}), from the encrypted windowing of y.
     # These are needed to compute the polynomial of degree minibin_capacity
-    all_powers = [None for i in range(minibin_capacity)]
-    for i in range(base - 1):
-        for j in range(logB_ell):
-            if ((i + 1) * base ** j - 1 < minibin_capacity):
-                all_powers[(i + 1) * base ** j - 1] = received_enc_query[i][j]
-
-    for k in range(minibin_capacity):
-        if all_powers[k] == None:
-            all_powers[k] = power_reconstruct(received_enc_query, k + 1)
-    all_powers = all_powers[::-1]
-
-    # Server sends alpha ciphertexts, obtained from performing dot_product between the polynomial coefficients from the preprocessed server database and all the powers Enc(y), ..., Enc(y^{minibin_capacity})
+    # The missing powers are computed level by level, following the power plan
+    with timer('deserialization'):
+        srv_context = ts.context_from(context_serialized)
+    all_powers = window_from_query(srv_context, window_serialized)
+    reconstruct_powers(all_powers, parallel_map)
+
+    # Server sends answer_ciphertexts ciphertexts, obtained from evaluating the minibin polynomials from the preprocessed server database on the powers of y
+    powers = Query_powers(all_powers)
     srv_answer = []
-    for i in range(alpha):
-        # the rows with index multiple of (B/alpha+1) have only 1's
-        dot_product = all_powers[0]
-        for j in range(1, minibin_capacity):
-            dot_product = dot_product + transposed_poly_coeffs[(minibin_capacity + 1) * i + j] * all_powers[j]
-        dot_product = dot_product + transposed_poly_coeffs[(minibin_capacity + 1) * i + minibin_capacity]
-        srv_answer.append(dot_product.serialize())
-
-    # The answer to be sent to the client is prepared
-    response_to_be_sent = pickle.dumps(srv_answer, protocol=None)
-    t3 = time()
-    L = len(response_to_be_sent)
-    sL = str(L) + ' ' * (10 - len(str(L))) #pad len to 10 bytes
-
-    conn.sendall((sL).encode())
-    conn.sendall(response_to_be_sent)
-
-    # Close the connection
-    print("Client disconnected \n")
-    print('Server ONLINE computation time {:.2f}s'.format(t1 - t0 + t3 - t2))
-
-    conn.close()
+    for answers in parallel_map(lambda groups: minibin_answers(powers, groups, batch), split(answer_groups, evaluation_threads)):
+        srv_answer = srv_answer + answers
+    if evaluation_mode == 'threads':
+        pool.shutdown()
+
+    return srv_answer
+
+def client_context(context_serialized):
+    '''
+    :return: the deserialized public HE context, taken from client_contexts if this worker process already worked for the client
+    '''
+    key = hashlib.blake2b(context_serialized, digest_size=16).digest()
+    with timer('deserialization'):
+        if key not in client_contexts:
+            client_contexts[key] = ts.context_from(context_serialized)
+            if len(client_contexts) > max_concurrent_clients:
+                client_contexts.popitem(last=False)
+        client_contexts.move_to_end(key)
+    return client_contexts[key]
+
+def minibin_answers_task(context_serialized, window_serialized, groups, batch):
+    '''
+    Rebuilds all the powers of the query from its window, and evaluates the given groups of minibins on them.
+    :return: the serialized answers of the server for the groups
+    '''
+    refresh_server_database()
+    all_powers = window_from_query(client_context(context_serialized), window_serialized)
+    reconstruct_powers(all_powers)
+    return minibin_answers(Query_powers(all_powers), groups, batch)
+
+async def run_measured(executor, session, function, *args):
+    '''
+    Runs function(*args) in a worker process, and adds the Metrics recorded by the worker to session.
+    :return: the output of the function
+    '''
+    output, snapshot = await asyncio.get_running_loop().run_in_executor(executor, measured, function, *args)
+    session.merge(snapshot)
+    return output
+
+async def answer_query_in_processes(executor, session, context_serialized, window_serialized, batch):
+    '''
+    The 'processes' evaluation mode of answer_query: the minibins are split among the worker processes, each one receiving the window of the query once
+    and rebuilding the powers it needs by itself, so that no ciphertext goes from one worker process to another.
+    '''
+    outputs = await asyncio.gather(*[run_measured(executor, session, minibin_answers_task, context_serialized, window_serialized, groups, batch) for groups in split(answer_groups, evaluation_workers)])
+    return [answer for output in outputs for answer in output]
+
+async def receive(reader, frame_type, session):
+    '''
+    :return: the payload of the next frame, which should have the given type; the time spent waiting for it and its size are added to session
+    '''
+    with session.timer('network_receive'):
+        payload = await read_frame(reader, frame_type)
+    session.count('bytes_received', frame_header.size + len(payload))
+    return payload
+
+async def send(writer, frame_type, payloads, session):
+    '''
+    Sends every payload in its own frame of the given type; the time spent sending them and their size are added to session.
+    '''
+    with session.timer('network_send'):
+        for payload in payloads:
+            write_frame(writer, frame_type, payload)
+            session.count('bytes_sent', frame_header.size + len(payload))
+        await writer.drain()
+
+async def answer_batch(executor, session, context_serialized, window_serialized, batch):
+    '''
+    :return: the answer to the query for the batch, computed by the worker processes of executor (which hold the columns of the batch)
+    '''
+    if evaluation_mode == 'processes':
+        return await answer_query_in_processes(executor, session, context_serialized, window_serialized, batch)
+    return await run_measured(executor, session, answer_query, context_serialized, window_serialized, batch)
+
+def shard_batches(shards):
+    '''
+    :return: the batches of bins of every shard, as ranges: the batches are dealt to the shards in turn, so that consecutive batches of a query go to different shards
+    '''
+    return [range(k, number_of_batches, shards) for k in range(shards)]
+
+def shard_socket(port, k):
+    return os.path.join(shard_socket_directory, 'psi_shard_{}_{}'.format(port, k))
+
+async def in_order(previous, coroutine):
+    '''
+    Runs the coroutine once the task previous (if not None) is done, so that the answers of one connection are computed, sent or read in the order of the queries.
+    '''
+    try:
+        if previous is not None:
+            await previous
+    except BaseException:
+        coroutine.close()
+        raise
+    return await coroutine
+
+async def answer_and_send(executor, session, writer, context_serialized, window_serialized, batch):
+    with session.timer('query'):
+        srv_answer = await answer_batch(executor, session, context_serialized, window_serialized, batch)
+    await send(writer, answer_frame, srv_answer, session)
+
+async def serve_shard(reader, writer, executor):
+    '''
+    Serves one connection of the sharded server: the context of a client, then the queries of the client for the batches of this shard, until the connection is closed.
+    The batch of every query comes in a shard_batch_frame before its window. The queries are read while the previous ones are answered, as long as
+    fewer than in_flight_batches of them are waiting for their answers, and the answers are sent in the order of the queries.
+    '''
+    session = Metrics()
+    answers = deque()
+    try:
+        context_serialized = await receive(reader, context_frame, session)
+        while True:
+            try:
+                payload = await read_frame(reader, shard_batch_frame)
+            except asyncio.IncompleteReadError as e:
+                if e.partial:
+                    raise
+                # the server closed the connection after the last batch
+                break
+            batch, = batch_index.unpack(payload)
+            if batch not in loaded_batches:
+                raise ValueError('batch {} does not belong to this shard'.format(batch))
+            window_serialized = [await receive(reader, query_frame, session) for exponent in window]
+            answers.append(asyncio.ensure_future(in_order(answers[-1] if answers else None, answer_and_send(executor, session, writer, context_serialized, window_serialized, batch))))
+            if len(answers) == in_flight_batches:
+                await answers.popleft()
+        if answers:
+            await answers[-1]
+        export_metrics('shard', session.snapshot(), batches=','.join(str(batch) for batch in loaded_batches))
+    except (asyncio.IncompleteReadError, ConnectionError) as e:
+        print('Shard connection lost: {}'.format(e))
+    except ValueError as e:
+        print('Shard received an invalid message: {}'.format(e))
+    finally:
+        for answer in answers:
+            answer.cancel()
+        await asyncio.gather(*answers, return_exceptions=True)
+        writer.close()
+
+async def shard_main(database, batches, path, ready=None):
+    '''
+    Serves the queries for the given batches on the Unix socket path until cancelled, with shard_workers worker processes,
+    which only read (and encode as plaintexts) the part of the database for these batches.
+    '''
+    global evaluation_workers
+    evaluation_workers = shard_workers
+    load_server_database(database, encode_plaintexts=False, batches=batches)
+    with ProcessPoolExecutor(shard_workers, initializer=load_server_database, initargs=(database, True, batches)) as executor:
+        if os.path.exists(path):
+            os.remove(path)
+        server = await asyncio.start_unix_server(lambda reader, writer: serve_shard(reader, writer, executor), path)
+        if ready is not None:
+            ready.set()
+        async with server:
+            await server.serve_forever()
+
+def run_shard(database, batches, path, ready):
+    asyncio.run(shard_main(database, batches, path, ready))
+
+def start_shards(database, port):
+    '''
+    Starts the shard processes of the database file, and waits until they listen.
+    :return: the processes and, for every shard, its Unix socket and its batches
+    '''
+    if not isinstance(database, str):
+        raise ValueError('the sharded server needs the preprocessed database in a file')
+    # the shard processes do not inherit the event loop and the sockets of the server
+    context = multiprocessing.get_context('spawn')
+    shards = [(shard_socket(port, k), batches) for k, batches in enumerate(shard_batches(min(server_shards, number_of_batches)))]
+    processes = []
+    for path, batches in shards:
+        ready = context.Event()
+        process = context.Process(target=run_shard, args=(database, batches, path, ready))
+        process.start()
+        processes.append((process, ready))
+    for process, ready in processes:
+        while not ready.wait(1):
+            if not process.is_alive():
+                raise RuntimeError('a shard process of the server failed to start')
+    return [process for process, ready in processes], shards
+
+async def forward_to_shard(shards, connections, context_serialized, window_serialized, batch):
+    '''
+    Forwards the query for the batch to the shard owning it, without waiting for its answer.
+    :param connections: the connections of the client session to the shards used so far, opened (and sent the context) when first needed
+    :return: the index of the shard
+    '''
+    k = next(k for k, (path, batches) in enumerate(shards) if batch in batches)
+    if k not in connections:
+        connections[k] = await asyncio.open_unix_connection(shards[k][0])
+        write_frame(connections[k][1], context_frame, context_serialized)
+    reader, writer = connections[k]
+    write_frame(writer, shard_batch_frame, batch_index.pack(batch))
+    for ciphertext in window_serialized:
+        write_frame(writer, query_frame, ciphertext)
+    await writer.drain()
+    return k
+
+async def shard_answer(reader):
+    '''
+    :return: the answer of a shard to the next query forwarded on the connection of reader
+    '''
+    return [await read_frame(reader, answer_frame) for j in range(answer_ciphertexts)]
+
+async def serve_client(reader, writer, executor, sessions, key=oprf_server_key, shards=None):
+    '''
+    Serves one client: the OPRF layer, then the answer to its encrypted query.
+    At most max_concurrent_clients clients are served at the same time; the other ones wait, with their data left unread in the socket buffers.
+    The Metrics of the client (with the ones recorded by the worker processes for it) are printed and exported at the end.
+    :param shards: for the sharded server, the Unix socket and the batches of every shard, which answer the queries; None if the worker processes of executor answer them
+    '''
+    session = Metrics()
+    # the connections to the shards, for this client, and the task reading the answer to the last batch forwarded to each of them
+    connections = {}
+    last_answers = {}
+    # the tasks computing (or reading from the shards) the answers to the batches of the query which are not sent yet, at most in_flight_batches of them
+    answers = deque()
+
+    async def send_answer(srv_answer):
+        with session.timer('query'):
+            srv_answer = await srv_answer
+        # one frame for each of the answer_ciphertexts ciphertexts of the answer
+        session.count('answer_ciphertexts', len(srv_answer))
+        session.count('answer_ciphertext_bytes', sum(len(answer) for answer in srv_answer))
+        await send(writer, answer_frame, srv_answer, session)
+
+    async with sessions:
+        try:
+            # OPRF layer: the server receives the encoded set elements as curve points
+            encoded_client_set = await receive(reader, oprf_query_frame, session)
+            # The server computes the online part of the OPRF protocol using its own secret key, with the work split among the worker processes
+            # The points are decompressed, checked to be on the curve and compressed again by the workers, in chunks of a multiple of 8 points
+            with session.timer('oprf'):
+                points_per_chunk = 8 * max(1, -(-number_of_compressed_points(encoded_client_set) // (8 * server_workers)))
+                outputs = await asyncio.gather(*[run_measured(executor, session, oprf_layer, chunk, key) for chunk in split_compressed(encoded_client_set, points_per_chunk)])
+            await send(writer, oprf_answer_frame, [join_compressed(outputs)], session)
+            print(' * OPRF layer done!')
+
+            # The server receives bytes that represent the public HE context, and then the query ciphertexts of the batches of bins, reading the query for a batch
+            # only when fewer than in_flight_batches batches are waiting for their answers: without shards, every batch is answered by the worker processes before
+            # the next one is read; with shards, every batch is forwarded to its shard as soon as it has arrived, so that the shards work at the same time
+            # (the answers of each shard are read in the order of its batches, as soon as they come)
+            context_serialized = await receive(reader, context_frame, session)
+            # the client queries every batch once, and then the batches of the extra queries for the items of its Cuckoo stash
+            payload = await receive(reader, stash_batches_frame, session)
+            if len(payload) % batch_index.size != 0:
+                raise ValueError('the stash batches frame has {} bytes'.format(len(payload)))
+            stash_batches = [batch for batch, in batch_index.iter_unpack(payload)]
+            if any(batch >= number_of_batches for batch in stash_batches):
+                raise ValueError('the stash batches {} are not all below {}'.format(stash_batches, number_of_batches))
+            session.count('stash_queries', len(stash_batches))
+            for batch in list(range(number_of_batches)) + stash_batches:
+                # The answers are sent in the order of the batches
+                if len(answers) == in_flight_batches:
+                    await send_answer(answers.popleft())
+                # one frame for each ciphertext of the window
+                window_serialized = [await receive(reader, query_frame, session) for exponent in window]
+                session.count('query_ciphertexts', len(window_serialized))
+                if shards is None:
+                    answers.append(asyncio.ensure_future(answer_batch(executor, session, context_serialized, window_serialized, batch)))
+                else:
+                    k = await forward_to_shard(shards, connections, context_serialized, window_serialized, batch)
+                    answers.append(asyncio.ensure_future(in_order(last_answers.get(k), shard_answer(connections[k][0]))))
+                    last_answers[k] = answers[-1]
+            while answers:
+                await send_answer(answers.popleft())
+            print("Client disconnected \n")
+            print('Server ONLINE computation time {:.2f}s'.format(session.computation_time(['oprf', 'query'])))
+            snapshot = session.snapshot()
+            print(metrics_summary(snapshot))
+            export_metrics('server', snapshot, client='{}:{}'.format(*writer.get_extra_info('peername')[:2]), evaluation_engine=evaluation_engine, evaluation_mode=evaluation_mode)
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            print('Client connection lost: {}'.format(e))
+        except ValueError as e:
+            # a frame of the wrong type, or a malformed payload
+            print('Client sent an invalid message: {}'.format(e))
+        finally:
+            # Close the connection, and the ones to the shards
+            for srv_answer in answers:
+                srv_answer.cancel()
+            await asyncio.gather(*answers, return_exceptions=True)
+            writer.close()
+            for shard_reader, shard_writer in connections.values():
+                shard_writer.close()
+
+async def main(ready=None, database='server_preprocessed', key=oprf_server_key, host='localhost', port=4470):
+    '''
+    Serves the clients until cancelled; ready, if given, is a threading.Event set once the server is listening.
+    :param database: the name of the file of the preprocessed database (memory-mapped by every worker process), or its columns as an array (copied to every worker process)
+    :param key: the OPRF key of the server, the one its database was preprocessed with
+    With server_shards > 0, the queries are answered by shard processes, and the worker processes of the server only run the OPRF layer.
+    '''
+    # the database is checked here, and loaded (with its plaintexts encoded) by every worker process
+    if isinstance(database, str):
+        load_database(database)
+    reconstruct_multiplications, reconstruct_depth = power_reconstruct_cost(ell, minibin_capacity)
+    print(' * Evaluation engine {}: {} ciphertext multiplications, depth {} (flat with power_reconstruct: {} multiplications, depth {})'.format(evaluation_engine, evaluation_multiplications, evaluation_depth, reconstruct_multiplications, reconstruct_depth + 1))
+    # the worker processes of a shard only encode the columns of its batches
+    batches = shard_batches(min(server_shards, number_of_batches))[0] if server_shards > 0 else range(number_of_batches)
+    columns = len(batches) * alpha * len(coefficient_forms())
+    print(' * Every one of the {} worker processes keeps {} of the {} columns of {} encoded as plaintexts, in {} MB'.format(caching_processes, len(cached_columns(batches)), columns, 'its shard' if server_shards > 0 else 'the database', plaintext_cache_mb // caching_processes))
+    print(' * The answer to every batch is made of {} ciphertexts{}'.format(answer_ciphertexts, ', switched to a smaller coefficient modulus before being sent' if answer_compression else ''))
+    sessions = asyncio.Semaphore(max_concurrent_clients)
+    if server_shards > 0:
+        shard_processes, shards = start_shards(database, port)
+        for k, (path, batches) in enumerate(shards):
+            print(' * Shard {} answers the batches {}, on {}'.format(k, ', '.join(str(batch) for batch in batches), path))
+        initializer, initargs = None, ()
+    else:
+        shard_processes, shards = [], None
+        # The preprocessed database is loaded once per worker process and reused for all the clients
+        initializer, initargs = load_server_database, (database,)
+    try:
+        with ProcessPoolExecutor(server_workers, initializer=initializer, initargs=initargs) as executor:
+            server = await asyncio.start_server(lambda reader, writer: serve_client(reader, writer, executor, sessions, key, shards), host, port)
+            if ready is not None:
+                ready.set()
+            async with server:
+                await server.serve_forever()
+    finally:
+        for process in shard_processes:
+            process.terminate()
+            process.join()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
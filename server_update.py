@@ -0,0 +1,101 @@
+from parameters import number_of_hashes, output_bits, bin_capacity, alpha, hash_seeds, plain_modulus
+from simple_hash import location_array, dummy_msg_server, log_no_hashes
+from auxiliary_functions import coeffs_from_minibins
+from preprocessed_database import load_database
+from set_files import read_items
+from oprf import server_prf_offline_parallel, order_of_generator, G
+import numpy as np
+import os
+from time import time
+
+#server's PRF secret key
+oprf_server_key = 1234567891011121314151617181920
+
+minibin_capacity = int(bin_capacity / alpha)
+
+
+def hashed_entries(PRFed_items):
+    '''
+    :param PRFed_items: a NumPy array of PRFed items
+    :return: the locations and the item_left || index values of all the items, for all the hashes
+    '''
+    PRFed_items = np.asarray(PRFed_items, dtype=np.uint64)
+    locations = np.stack([location_array(hash_seeds[i], PRFed_items) for i in range(number_of_hashes)], axis=1)
+    values = ((PRFed_items >> np.uint64(output_bits)).astype(np.int64)[:, None] << log_no_hashes) + np.arange(number_of_hashes)
+    return locations.ravel().tolist(), values.ravel().tolist()
+
+def update_database(simple_hashed_data, transposed_poly_coeffs, PRFed_inserted, PRFed_deleted):
+    '''
+    :param simple_hashed_data: the (number_of_bins, bin_capacity) simple hashing table of the server, padded with dummy_msg_server
+    :param transposed_poly_coeffs: the (alpha * (minibin_capacity + 1), number_of_bins) columns of the coefficients matrix
+    :param PRFed_inserted: a NumPy array of PRFed items to be added to the database
+    :param PRFed_deleted: a NumPy array of PRFed items to be removed from the database
+    :return: the number of minibins whose polynomials were recomputed and the number of entries that did not fit in their bins
+    Both arrays are updated in place; only the polynomials of the minibins whose entries changed are recomputed.
+    '''
+    dirty_minibins = set()
+    overflow = 0
+    # only the first alpha * minibin_capacity places of a bin are covered by the minibin polynomials
+    used_places = alpha * minibin_capacity
+
+    locations, values = hashed_entries(PRFed_deleted)
+    for loc, value in zip(locations, values):
+        places = np.nonzero(simple_hashed_data[loc, :used_places] == value)[0]
+        for place in places.tolist():
+            simple_hashed_data[loc, place] = dummy_msg_server
+            dirty_minibins.add((loc, place // minibin_capacity))
+
+    locations, values = hashed_entries(PRFed_inserted)
+    for loc, value in zip(locations, values):
+        row = simple_hashed_data[loc, :used_places]
+        if (row == value).any():
+            continue
+        free_places = np.nonzero(row == dummy_msg_server)[0]
+        if len(free_places) == 0:
+            overflow += 1
+            continue
+        place = int(free_places[0])
+        simple_hashed_data[loc, place] = value
+        dirty_minibins.add((loc, place // minibin_capacity))
+
+    if dirty_minibins:
+        bins, minibins = np.array(sorted(dirty_minibins)).T
+        # only the places of the dirty minibins are read from the (possibly memory-mapped) table
+        roots = simple_hashed_data[bins[:, None], minibins[:, None] * minibin_capacity + np.arange(minibin_capacity)]
+        coefficients = coeffs_from_minibins(roots[:, None, :], plain_modulus)
+        for k in range(minibin_capacity + 1):
+            transposed_poly_coeffs[(minibin_capacity + 1) * minibins + k, bins] = coefficients[:, k]
+    return len(dirty_minibins), overflow
+
+def read_updates(filename):
+    if not os.path.exists(filename):
+        return []
+    return read_items(filename)
+
+
+if __name__ == '__main__':
+    # key * generator of elliptic curve
+    server_point_precomputed = (oprf_server_key % order_of_generator) * G
+
+    # The items to be added to (server_inserts) and removed from (server_deletes) the server database
+    inserted_items = read_updates('server_inserts')
+    deleted_items = read_updates('server_deletes')
+
+    t0 = time()
+    # Only the updated items go through the PRF
+    PRFed_inserted = np.array(list(set(server_prf_offline_parallel(inserted_items, server_point_precomputed))), dtype=np.uint64)
+    PRFed_deleted = np.array(list(set(server_prf_offline_parallel(deleted_items, server_point_precomputed))), dtype=np.uint64)
+
+    # The simple hashing table and the coefficients are updated in place, in their memory-mapped files
+    simple_hashed_data = load_database('server_hashed', mode='r+')
+    transposed_poly_coeffs = load_database('server_preprocessed', mode='r+')
+    touched, overflow = update_database(simple_hashed_data, transposed_poly_coeffs, PRFed_inserted, PRFed_deleted)
+    simple_hashed_data.flush()
+    transposed_poly_coeffs.flush()
+    # a running online server compares the modification time of the file to know that its encoded plaintexts must be computed again
+    os.utime('server_preprocessed')
+    t1 = time()
+    if overflow > 0:
+        print('Simple hashing aborted: {} entries did not fit in their bins'.format(overflow))
+    print('{} items inserted, {} items deleted, {} minibins recomputed'.format(len(inserted_items), len(deleted_items), touched))
+    print('Server UPDATE time {:.2f}s'.format(t1 - t0))
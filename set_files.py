@@ -0,0 +1,101 @@
+import struct
+from itertools import islice
+import numpy as np
+from parameters import ingestion_chunk_size
+
+# Files of sets of items: the binary format written by set_gen.py, or text files with one item per line.
+# Binary format: a header of header_size bytes (magic, version, count), followed by count unsigned 64-bit integers.
+# Both can be read chunk by chunk, so that a set does not need to fit in memory.
+magic = b'PSISET\x00\x00'
+version = 1
+header_format = '<8sIQ'
+header_size = 32
+entry_dtype = np.dtype('<u8')
+
+
+class Set_writer:
+    '''
+    Writes a set in the binary format, chunk by chunk; the header is completed when the writer is closed.
+    '''
+    def __init__(self, filename):
+        self.file = open(filename, 'wb')
+        self.file.write(bytes(header_size))
+        self.count = 0
+
+    def write(self, items):
+        '''
+        :param items: a NumPy array (or a list) of integers in [0, 2 ** 64)
+        '''
+        items = np.ascontiguousarray(items, dtype=entry_dtype)
+        self.file.write(items.tobytes())
+        self.count += len(items)
+
+    def close(self):
+        self.file.seek(0)
+        self.file.write(struct.pack(header_format, magic, version, self.count).ljust(header_size, b'\x00'))
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+def write_items(filename, items):
+    with Set_writer(filename) as writer:
+        writer.write(items)
+
+def is_binary_set(filename):
+    with open(filename, 'rb') as f:
+        return f.read(len(magic)) == magic
+
+def has_64_bit_items(filename, chunk_items=ingestion_chunk_size):
+    '''
+    :return: whether all the items of the file are in [0, 2 ** 64), so that it can be read by read_item_chunks (always true for the binary format)
+    '''
+    if is_binary_set(filename):
+        return True
+    with open(filename, 'r') as f:
+        while True:
+            lines = list(islice(f, chunk_items))
+            if not lines:
+                return True
+            if any(not 0 <= int(line) < 2 ** 64 for line in lines if line.strip()):
+                return False
+
+def read_item_chunks(filename, chunk_items=ingestion_chunk_size):
+    '''
+    :param filename: a file written by Set_writer, or a text file with one item per line
+    :param chunk_items: the number of items of a chunk
+    :return: a generator of NumPy arrays of at most chunk_items items, in the order of the file
+    '''
+    if is_binary_set(filename):
+        with open(filename, 'rb') as f:
+            file_magic, file_version, count = struct.unpack(header_format, f.read(header_size)[:struct.calcsize(header_format)])
+        if file_version != version:
+            raise ValueError('{} has format version {}, expected version {}'.format(filename, file_version, version))
+        if count == 0:
+            return
+        # the items are memory-mapped, so only the current chunk is read from disk
+        items = np.memmap(filename, dtype=entry_dtype, mode='r', offset=header_size, shape=(count,))
+        for k in range(0, count, chunk_items):
+            yield np.array(items[k: k + chunk_items], dtype=np.uint64)
+        return
+    with open(filename, 'r') as f:
+        while True:
+            lines = list(islice(f, chunk_items))
+            if not lines:
+                return
+            items = [int(line) for line in lines if line.strip()]
+            if any(item < 0 or item >= 2 ** 64 for item in items):
+                raise ValueError('{} has items outside [0, 2 ** 64), which can only be read whole with read_items'.format(filename))
+            yield np.array(items, dtype=np.uint64)
+
+def read_items(filename):
+    '''
+    :return: the items of a file written by Set_writer, or of a text file with one item per line (of any size), as a list of integers
+    '''
+    if is_binary_set(filename):
+        return [item for chunk in read_item_chunks(filename) for item in chunk.tolist()]
+    with open(filename, 'r') as f:
+        return [int(line) for line in f if line.strip()]
@@ -1,23 +1,30 @@
-from random import sample
-from parameters import server_size, client_size, intersection_size
+import numpy as np
+from parameters import server_size, client_size, intersection_size, ingestion_chunk_size
+from set_files import Set_writer, write_items
 
-#set elements can be integers < order of the generator of the elliptic curve (192 bits integers if P192 is used); 'sample' works only for a maximum of 63 bits integers.
-disjoint_union = sample(range(2 ** 63 - 1), server_size + client_size)
-intersection = disjoint_union[:intersection_size]
-server_set = intersection + disjoint_union[intersection_size: server_size]
-client_set = intersection + disjoint_union[server_size: server_size - intersection_size + client_size]
+# The sets are written in the binary format of set_files.py, the server set ingestion_chunk_size items at a time, so they never need to fit in memory.
+# The items are 63 bits integers, drawn from disjoint ranges: the intersection from [0, 2 ** 61), the other client items from [2 ** 61, 2 ** 62)
+# and the other server items from [2 ** 62, 2 ** 63).
+# The items of the intersection and of the client set are distinct; the other server items are drawn independently, so a few of them may repeat
+# (about server_size ** 2 / 2 ** 63 of them), and they are then inserted once by server_offline.py.
+rng = np.random.default_rng()
 
-f = open('server_set', 'w')
-for item in server_set:
-	f.write(str(item) + '\n')
-f.close()
+def distinct_items(size, low, high):
+	'''
+	:return: a NumPy array of size distinct random integers from [low, high)
+	'''
+	items = np.zeros(0, dtype=np.uint64)
+	while len(items) < size:
+		items = np.unique(np.concatenate((items, rng.integers(low, high, size=size - len(items), dtype=np.uint64))))
+	return rng.permutation(items)
 
-g = open('client_set', 'w')
-for item in client_set:
-	g.write(str(item) + '\n')
-g.close()		
+intersection = distinct_items(intersection_size, 0, 2 ** 61)
+client_set = np.concatenate((intersection, distinct_items(client_size - intersection_size, 2 ** 61, 2 ** 62)))
 
-h = open('intersection', 'w')
-for item in intersection:
-	h.write(str(item) + '\n')
-h.close()
+with Set_writer('server_set') as f:
+	f.write(intersection)
+	for k in range(intersection_size, server_size, ingestion_chunk_size):
+		f.write(rng.integers(2 ** 62, 2 ** 63, size=min(ingestion_chunk_size, server_size - k), dtype=np.uint64))
+
+write_items('client_set', client_set)
+write_items('intersection', intersection)
@@ -1,12 +1,23 @@
 from random import randint
 import math
 import mmh3
+import numpy as np
 
 #parameters
-from parameters import output_bits, number_of_hashes, bin_capacity
+from parameters import output_bits, number_of_hashes, bin_capacity, sigma_max
 log_no_hashes = int(math.log(number_of_hashes) / math.log(2)) + 1
 mask_of_power_of_2 = 2 ** output_bits - 1
 
+# the empty places of the bins hold dummy_msg_server, which is larger than any item_left || index
+dummy_msg_server = 2 ** (sigma_max - output_bits + log_no_hashes) + 1
+# the bins are stored in the smallest unsigned integer type that fits both the entries and dummy_msg_server
+entry_dtype = np.uint32 if dummy_msg_server < 2 ** 32 else np.uint64
+
+# constants of the 32 bits Murmur3 hash function (x86 variant), as used by mmh3.hash
+c1 = np.uint32(0xcc9e2d51)
+c2 = np.uint32(0x1b873593)
+powers_of_ten = np.array([10 ** k for k in range(20)], dtype=np.uint64)
+
 
 def left_and_index(item, index):
     '''
@@ -31,22 +42,167 @@ def location(seed, item):
     hash_item_left = mmh3.hash(str(item_left), seed, signed=False) >> (32 - output_bits)
     return hash_item_left ^ item_right
 
+def rotl(x, r):
+    return (x << np.uint32(r)) | (x >> np.uint32(32 - r))
+
+def murmur_hash_array(values, seed):
+    '''
+    :param values: a NumPy array of non-negative integers (at most 64 bits each)
+    :param seed: a seed of a Murmur hash function
+    :return: a uint32 NumPy array with entries mmh3.hash(str(value), seed, signed=False), computed for all the values at once
+    '''
+    values = np.asarray(values, dtype=np.uint64)
+    hashes = np.empty(len(values), dtype=np.uint32)
+    # str(value) has as many bytes as decimal digits, so we hash together the values with the same number of digits
+    number_of_digits = np.maximum(np.searchsorted(powers_of_ten, values, side='right'), 1)
+    for length in np.unique(number_of_digits):
+        positions = np.nonzero(number_of_digits == length)[0]
+        group = values[positions]
+        # the ASCII codes of the decimal digits, most significant digit first
+        digits = ((group[:, None] // powers_of_ten[length - 1::-1]) % np.uint64(10) + np.uint64(48)).astype(np.uint32)
+        h = np.full(len(group), seed & 0xffffffff, dtype=np.uint32)
+        for b in range(length // 4):
+            k = digits[:, 4 * b] | (digits[:, 4 * b + 1] << np.uint32(8)) | (digits[:, 4 * b + 2] << np.uint32(16)) | (digits[:, 4 * b + 3] << np.uint32(24))
+            k = rotl(k * c1, 15) * c2
+            h = rotl(h ^ k, 13) * np.uint32(5) + np.uint32(0xe6546b64)
+        tail = length % 4
+        if tail > 0:
+            k = np.zeros(len(group), dtype=np.uint32)
+            for r in range(tail - 1, -1, -1):
+                k = k ^ (digits[:, length - tail + r] << np.uint32(8 * r))
+            h = h ^ (rotl(k * c1, 15) * c2)
+        h = h ^ np.uint32(length)
+        h = h ^ (h >> np.uint32(16))
+        h = h * np.uint32(0x85ebca6b)
+        h = h ^ (h >> np.uint32(13))
+        h = h * np.uint32(0xc2b2ae35)
+        hashes[positions] = h ^ (h >> np.uint32(16))
+    return hashes
+
+def location_array(seed, items):
+    '''
+    :param seed: a seed of a Murmur hash function
+    :param items: a NumPy array of integers
+    :return: a NumPy array with location(seed, item) for every item
+    '''
+    items = np.asarray(items, dtype=np.uint64)
+    hash_items_left = murmur_hash_array(items >> np.uint64(output_bits), seed) >> np.uint32(32 - output_bits)
+    return hash_items_left.astype(np.int64) ^ (items & np.uint64(mask_of_power_of_2)).astype(np.int64)
+
+class Bloom_filter():
+    '''
+    A Bloom filter of 64 bits integers, stored as a NumPy array of bits: every value sets number_of_probes bits, chosen by multiply-shift hashing.
+    It never misses a value that was added, and wrongly contains about 1% of the other values when it holds capacity values.
+    '''
+
+    def __init__(self, capacity, bits_per_value=10, number_of_probes=7):
+        self.log_bits = max(6, int(math.ceil(math.log2(max(1, capacity) * bits_per_value))))
+        self.bits = np.zeros(2 ** self.log_bits // 8, dtype=np.uint8)
+        # odd 64 bits multipliers, one per probe
+        self.multipliers = np.random.default_rng(0).integers(0, 2 ** 63, size=number_of_probes, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+
+    def positions(self, values):
+        '''
+        :return: the positions of the bits of the values, as an array of shape (len(values), number_of_probes)
+        '''
+        values = np.asarray(values, dtype=np.uint64)
+        return (values[:, None] * self.multipliers) >> np.uint64(64 - self.log_bits)
+
+    def add(self, values):
+        positions = self.positions(values).ravel()
+        np.bitwise_or.at(self.bits, positions >> np.uint64(3), np.uint8(1) << (positions & np.uint64(7)).astype(np.uint8))
+
+    def contains(self, values):
+        '''
+        :return: a boolean array telling which values may have been added
+        '''
+        positions = self.positions(values)
+        return ((self.bits[positions >> np.uint64(3)] >> (positions & np.uint64(7)).astype(np.uint8)) & 1).all(axis=1)
+
 class Simple_hash():
 
-    def __init__(self, hash_seed):
+    def __init__(self, hash_seed, deduplicate=False):
+        '''
+        :param deduplicate: whether insert_array leaves out the items which are already in the table, for example from a previous chunk of the set;
+        a Bloom filter of the inserted items then tells which items need to be looked up in their bins
+        '''
         self.no_bins = 2 ** output_bits
-        self.simple_hashed_data = [[None for j in range(bin_capacity)] for i in range(self.no_bins)]
-        self.occurences = [0 for i in range(self.no_bins)]
+        # bins are the rows of a fixed-width table, already padded with dummy_msg_server
+        self.simple_hashed_data = np.full((self.no_bins, bin_capacity), dummy_msg_server, dtype=entry_dtype)
+        self.occurences = np.zeros(self.no_bins, dtype=np.int64)
         self.FAIL = 0
         self.hash_seed = hash_seed
         self.bin_capacity = bin_capacity
+        # the table holds at most no_bins * bin_capacity / number_of_hashes items
+        self.inserted = Bloom_filter(self.no_bins * bin_capacity // number_of_hashes) if deduplicate else None
 
     #  insert item using hash i on position given by location
     def insert(self, item, i):
         loc = location(self.hash_seed[i], item)
         if (self.occurences[loc] < self.bin_capacity):
-            self.simple_hashed_data[loc][self.occurences[loc]] = left_and_index(item, i)
+            self.simple_hashed_data[loc, self.occurences[loc]] = left_and_index(item, i)
             self.occurences[loc] += 1
         else:
             self.FAIL = 1
             print('Simple hashing aborted')
+
+    def present(self, items, block=2 ** 22):
+        '''
+        :param items: a NumPy array of integers
+        :return: a boolean array telling which items are already in the table
+        Only the items that may be in the Bloom filter of the inserted items are looked up, in the bins of all their hashes
+        (the item_left || index of an entry and its bin determine the item, and a bin may have been too full to hold it);
+        the bins are compared in blocks of about block places.
+        '''
+        found = np.zeros(len(items), dtype=bool)
+        candidates = np.flatnonzero(self.inserted.contains(items))
+        lefts = (items[candidates] >> np.uint64(output_bits)).astype(np.int64) << log_no_hashes
+        step = max(1, block // self.bin_capacity)
+        for i in range(number_of_hashes):
+            locations = location_array(self.hash_seed[i], items[candidates])
+            values = (lefts + i).astype(entry_dtype)
+            for k in range(0, len(candidates), step):
+                found[candidates[k: k + step]] |= (self.simple_hashed_data[locations[k: k + step]] == values[k: k + step, None]).any(axis=1)
+        return found
+
+    def insert_array(self, items):
+        '''
+        :param items: a NumPy array of distinct integers (in the protocol, the PRFed server set)
+        :return: a vector with the number of entries that did not fit in each bin
+        Inserts every item with all the number_of_hashes hashes, filling the bins exactly as calling insert(item, i) for each item and each i would.
+        With deduplicate, the items may repeat: every item is inserted once, at its first occurrence, and the items already in the table are left out.
+        '''
+        items = np.asarray(items, dtype=np.uint64)
+        if self.inserted is not None:
+            # every item is tested once, before any of its entries is placed
+            first_occurrences = np.sort(np.unique(items, return_index=True)[1])
+            items = items[first_occurrences]
+            items = items[~self.present(items)]
+            self.inserted.add(items)
+        locations = np.stack([location_array(self.hash_seed[i], items) for i in range(number_of_hashes)], axis=1).ravel()
+        values = ((items >> np.uint64(output_bits)).astype(np.int64)[:, None] << log_no_hashes) + np.arange(number_of_hashes)
+        values = values.ravel()
+
+        # a stable sort keeps, inside every bin, the order in which insert would have placed the entries
+        order = np.argsort(locations, kind='stable')
+        sorted_locations = locations[order]
+        counts = np.bincount(locations, minlength=self.no_bins)
+        first_in_bin = np.cumsum(counts) - counts
+        slots = np.arange(len(order)) - first_in_bin[sorted_locations] + self.occurences[sorted_locations]
+        fits = slots < self.bin_capacity
+        self.simple_hashed_data[sorted_locations[fits], slots[fits]] = values[order][fits]
+
+        new_occurences = np.minimum(self.occurences + counts, self.bin_capacity)
+        overflow = self.occurences + counts - new_occurences
+        self.occurences = new_occurences
+        if overflow.any():
+            self.FAIL = 1
+        return overflow
+
+    def minibins(self, alpha):
+        '''
+        :param alpha: the partitioning parameter
+        :return: a view of the table with shape (no_bins, alpha, bin_capacity // alpha), where entry [i][j] is the j-th minibin of bin i
+        '''
+        minibin_capacity = self.bin_capacity // alpha
+        return self.simple_hashed_data[:, :alpha * minibin_capacity].reshape(self.no_bins, alpha, minibin_capacity)